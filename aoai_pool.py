@@ -0,0 +1,209 @@
+# Pool of Azure OpenAI deployments used by the video analysis apps
+import os
+import json
+import time
+import random
+import threading
+import openai
+from openai import AzureOpenAI
+
+# Default configuration
+CIRCUIT_BREAK_SECONDS = 30  # How long a deployment is skipped after CIRCUIT_BREAK_FAILURES consecutive 429/5xx
+CIRCUIT_BREAK_FAILURES = 3
+MAX_RETRIES = 2  # Times a request waits and retries once every deployment failed (as the SDK default)
+INITIAL_RETRY_DELAY = 0.5  # Exponential backoff of the retries without Retry-After (as the SDK)
+MAX_RETRY_DELAY = 8.0
+MAX_WAIT_SECONDS = 60  # Longest single wait for a circuit to close
+TOKENS_PER_IMAGE = 765  # Rough cost of an image with detail "auto" (a 512px tile plus the base tokens)
+CHARS_PER_TOKEN = 4
+
+# One deployment of a model (GPT-4o or Whisper) in one Azure region
+class Deployment:
+    def __init__(self, endpoint, api_key, api_version, deployment_name, weight=1, region=''):
+        self.endpoint = endpoint
+        self.api_version = api_version
+        self.deployment_name = deployment_name
+        self.weight = max(float(weight), 0.001)
+        self.region = region
+        self.client = AzureOpenAI(
+            azure_deployment=deployment_name,
+            api_version=api_version,
+            azure_endpoint=endpoint,
+            api_key=api_key,
+            max_retries=0  # The pool does the failover and the retries, so the SDK must not retry on its own
+        )
+        self.outstanding_tokens = 0
+        self.open_until = 0.0  # Circuit breaker: the deployment is skipped until this time
+        self.failures = 0
+
+    def is_available(self, now):
+        return self.open_until <= now
+
+    def load(self):
+        # Outstanding tokens relative to the weight of the deployment
+        return self.outstanding_tokens / self.weight
+
+    def __repr__(self):
+        return f'Deployment({self.deployment_name} @ {self.endpoint}, weight={self.weight})'
+
+# Routes requests to the deployment with the least outstanding tokens, skipping the ones with an open circuit
+class DeploymentPool:
+    def __init__(self, deployments, circuit_break_seconds=CIRCUIT_BREAK_SECONDS, max_retries=MAX_RETRIES):
+        if not deployments:
+            raise ValueError('At least one deployment is required')
+        self.deployments = list(deployments)
+        self.circuit_break_seconds = circuit_break_seconds
+        self.max_retries = max_retries
+        self.lock = threading.Lock()
+
+    # Pick the next deployment, excluding the ones already tried for this request and the ones with an open circuit
+    def _acquire(self, tokens, tried):
+        with self.lock:
+            now = time.time()
+            candidates = [d for d in self.deployments if d not in tried and d.is_available(now)]
+            if not candidates:
+                return None
+            lowest = min(d.load() for d in candidates)
+            # Break ties randomly so that equal deployments share the traffic
+            deployment = random.choice([d for d in candidates if d.load() == lowest])
+            deployment.outstanding_tokens += tokens
+            return deployment
+
+    # Release the tokens of a request. success closes the circuit, and any other error (e.g. a bad request)
+    # leaves it as it is. A retryable error opens it for the Retry-After of the response or, with several
+    # deployments to fail over to, after CIRCUIT_BREAK_FAILURES consecutive failures
+    def _release(self, deployment, tokens, success=False, error=None):
+        with self.lock:
+            deployment.outstanding_tokens -= tokens
+            if success:
+                deployment.failures = 0
+                deployment.open_until = 0.0
+            elif error is not None:
+                deployment.failures += 1
+                wait = retry_after_seconds(error)
+                if wait is None and len(self.deployments) > 1 and deployment.failures >= CIRCUIT_BREAK_FAILURES:
+                    wait = self.circuit_break_seconds * min(deployment.failures - CIRCUIT_BREAK_FAILURES + 1, 4)
+                if wait is not None:
+                    deployment.open_until = max(deployment.open_until, time.time() + wait)
+
+    # Seconds to wait before the next retry of a request: until the first circuit closes,
+    # and at least the exponential backoff of the retry
+    def _wait_seconds(self, retry):
+        with self.lock:
+            open_until = min(d.open_until for d in self.deployments)
+        backoff = min(INITIAL_RETRY_DELAY * 2 ** retry, MAX_RETRY_DELAY) * (1 - 0.25 * random.random())
+        return min(max(open_until - time.time(), backoff), MAX_WAIT_SECONDS)
+
+    # Execute call(client, deployment_name) on the best deployment and fail over to the others on 429/5xx errors.
+    # Once every deployment has failed (or has an open circuit), wait for the first circuit to close and retry,
+    # at most max_retries times
+    def call(self, call, tokens=0):
+        tried = []
+        last_error = None
+        retries = 0
+        while True:
+            deployment = self._acquire(tokens, tried)
+            if deployment is None:
+                if retries >= self.max_retries:
+                    raise last_error or RuntimeError('No deployment available: every circuit is open')
+                wait = self._wait_seconds(retries)
+                retries += 1
+                print(f'WARNING: no deployment available, retrying in {wait:.1f} s ({retries}/{self.max_retries})')
+                time.sleep(wait)
+                tried = []
+                continue
+            tried.append(deployment)
+            try:
+                result = call(deployment.client, deployment.deployment_name)
+            except Exception as ex:
+                if not is_retryable(ex):
+                    self._release(deployment, tokens)
+                    raise
+                self._release(deployment, tokens, error=ex)
+                print(f'WARNING: {deployment} failed ({ex})')
+                last_error = ex
+                continue
+            self._release(deployment, tokens, success=True)
+            return result
+
+    def status(self):
+        with self.lock:
+            now = time.time()
+            return [{
+                "deployment": d.deployment_name,
+                "endpoint": d.endpoint,
+                "region": d.region,
+                "weight": d.weight,
+                "outstanding_tokens": d.outstanding_tokens,
+                "failures": d.failures,
+                "available": d.is_available(now),
+            } for d in self.deployments]
+
+# 429 (throttling), 5xx, connection errors and timeouts are worth retrying on another deployment
+def is_retryable(ex):
+    if isinstance(ex, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)):
+        return True
+    if isinstance(ex, openai.APIStatusError):
+        return ex.status_code == 429 or ex.status_code >= 500
+    return False
+
+def retry_after_seconds(ex):
+    response = getattr(ex, 'response', None)
+    if response is None:
+        return None
+    for header in ('retry-after-ms', 'retry-after'):
+        value = response.headers.get(header)
+        if value is None:
+            continue
+        try:
+            seconds = float(value)
+        except ValueError:
+            continue
+        return seconds / 1000 if header == 'retry-after-ms' else seconds
+    return None
+
+# Rough estimation of the tokens of a chat completion request, used to balance the load
+def estimate_chat_tokens(messages, max_tokens=0):
+    tokens = max_tokens
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, str):
+            tokens += len(content) // CHARS_PER_TOKEN
+            continue
+        for part in content:
+            if part["type"] == "image_url":
+                tokens += TOKENS_PER_IMAGE
+            else:
+                tokens += len(part.get("text", "")) // CHARS_PER_TOKEN
+    return tokens
+
+# Load the deployments from the environment.
+# {prefix}_DEPLOYMENTS can contain a JSON list of deployments, e.g.:
+#   [{"endpoint": "https://eastus.openai.azure.com/", "api_key": "...", "deployment": "gpt-4o", "weight": 2, "region": "eastus"}, ...]
+# "api_key", "api_version" and "deployment" are optional and default to the single deployment variables.
+# Without {prefix}_DEPLOYMENTS only the single deployment ({prefix}_ENDPOINT, ...) is used.
+def load_deployments(prefix, endpoint_var, api_key_var, api_version_var, deployment_var):
+    api_key = os.environ[api_key_var]
+    api_version = os.environ[api_version_var]
+    deployment_name = os.environ[deployment_var]
+    config = os.environ.get(f'{prefix}_DEPLOYMENTS', '').strip()
+    if not config:
+        return [Deployment(os.environ[endpoint_var], api_key, api_version, deployment_name)]
+
+    deployments = []
+    for entry in json.loads(config):
+        deployments.append(Deployment(
+            entry["endpoint"],
+            entry.get("api_key", api_key),
+            entry.get("api_version", api_version),
+            entry.get("deployment", deployment_name),
+            weight=entry.get("weight", 1),
+            region=entry.get("region", '')
+        ))
+    return deployments
+
+def create_aoai_pool():
+    return DeploymentPool(load_deployments('AZURE_OPENAI', 'AZURE_OPENAI_ENDPOINT', 'AZURE_OPENAI_API_KEY', 'AZURE_OPENAI_API_VERSION', 'AZURE_OPENAI_DEPLOYMENT_NAME'))
+
+def create_whisper_pool():
+    return DeploymentPool(load_deployments('WHISPER', 'WHISPER_ENDPOINT', 'WHISPER_API_KEY', 'WHISPER_API_VERSION', 'WHISPER_DEPLOYMENT_NAME'))
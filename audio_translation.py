@@ -0,0 +1,133 @@
+# Batch translation pipeline for long audio files: continuous recognition -> batched translation -> parallel synthesis.
+# The services are passed as callables/objects, so the pipeline runs with the Azure services or with local stand-ins:
+#   recognize(on_sentence): blocks until the audio ends, calling on_sentence(text) for each recognized sentence
+#   translator.translate(texts, languages): returns one {language: translated_text} dict per text
+#   synthesize(text, language, output_path): writes the speech of the text as a WAV file
+import os
+import wave
+import threading
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+# Default configuration
+BATCH_SENTENCES = 25  # Sentences per translator request
+MAX_REQUEST_TEXTS = 1000  # Translator limit of texts per request
+MAX_REQUEST_CHARS = 50000  # Translator limit of characters per request (counted once per target language)
+TRANSLATION_WORKERS = 4
+SYNTHESIS_WORKERS = 4
+
+# Azure Translator Text API v3: several texts and target languages in one request
+class TranslatorClient:
+    def __init__(self, endpoint, key, region, session=None):
+        self.url = f"{endpoint.rstrip('/')}/translator/text/v3.0/translate"
+        self.headers = {
+            "Ocp-Apim-Subscription-Key": key,
+            "Ocp-Apim-Subscription-Region": region,
+            "Content-Type": "application/json"
+        }
+        self.session = session or requests.Session()
+
+    def translate(self, texts, languages):
+        response = self.session.post(self.url, params=[("to", language) for language in languages], headers=self.headers, json=[{"text": text} for text in texts])
+        if response.status_code != 200:
+            raise RuntimeError(f"Translation failed. Error: {response.text}")
+        return [{translation["to"]: translation["text"] for translation in result["translations"]} for result in response.json()]
+
+class TranslationResult:
+    def __init__(self, languages):
+        self.sentences = []
+        self.translations = {language: [] for language in languages}
+        self.audio_paths = {}
+
+    @property
+    def transcription(self):
+        return " ".join(self.sentences)
+
+    def translation(self, language):
+        return " ".join(self.translations[language])
+
+# Groups the recognized sentences into translator requests and submits them as soon as a batch is full,
+# so translation and synthesis run while the recognition continues
+class SentenceBatcher:
+    def __init__(self, submit, languages, batch_sentences=BATCH_SENTENCES):
+        self.submit = submit
+        self.max_texts = min(batch_sentences, MAX_REQUEST_TEXTS)
+        self.max_chars = MAX_REQUEST_CHARS // max(1, len(languages))
+        self.pending = []
+        self.pending_chars = 0
+        self.lock = threading.Lock()
+
+    def add(self, sentence):
+        sentence = sentence.strip()
+        if not sentence:
+            return
+        with self.lock:
+            if self.pending and self.pending_chars + len(sentence) > self.max_chars:
+                self._flush()
+            self.pending.append(sentence)
+            self.pending_chars += len(sentence)
+            if len(self.pending) >= self.max_texts:
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self.pending:
+            self.submit(self.pending)
+        self.pending = []
+        self.pending_chars = 0
+
+# Concatenate the WAV parts (same format) into one file
+def concatenate_wav(part_paths, output_path):
+    with wave.open(output_path, "wb") as output:
+        for i, part_path in enumerate(part_paths):
+            with wave.open(part_path, "rb") as part:
+                if i == 0:
+                    output.setparams(part.getparams())
+                output.writeframes(part.readframes(part.getnframes()))
+    return output_path
+
+# Run the pipeline and write one translated_<language>.wav per target language into work_dir
+def translate_audio(recognize, translator, synthesize, languages, work_dir, batch_sentences=BATCH_SENTENCES, translation_workers=TRANSLATION_WORKERS, synthesis_workers=SYNTHESIS_WORKERS):
+    os.makedirs(work_dir, exist_ok=True)
+    result = TranslationResult(languages)
+    batches = []  # (sentences, future of the translations) in order of recognition
+
+    with ThreadPoolExecutor(max_workers=translation_workers) as translation_pool, ThreadPoolExecutor(max_workers=synthesis_workers) as synthesis_pool:
+        # Translate one batch and start the synthesis of each language in parallel
+        def translate_batch(batch_number, sentences):
+            translated = translator.translate(sentences, languages)
+            synthesis = {}
+            for language in languages:
+                text = " ".join(item[language] for item in translated)
+                part_path = os.path.join(work_dir, f"part_{batch_number:05d}_{language}.wav")
+                synthesis[language] = (part_path, synthesis_pool.submit(synthesize, text, language, part_path))
+            return translated, synthesis
+
+        def submit(sentences):
+            batches.append((sentences, translation_pool.submit(translate_batch, len(batches), sentences)))
+
+        batcher = SentenceBatcher(submit, languages, batch_sentences)
+        recognize(batcher.add)
+        batcher.flush()
+
+        # Reassemble the batches in order
+        parts = {language: [] for language in languages}
+        for sentences, future in batches:
+            translated, synthesis = future.result()
+            result.sentences.extend(sentences)
+            for language in languages:
+                result.translations[language].extend(item[language] for item in translated)
+                part_path, synthesized = synthesis[language]
+                synthesized.result()
+                parts[language].append(part_path)
+
+    for language in languages:
+        if parts[language]:
+            result.audio_paths[language] = concatenate_wav(parts[language], os.path.join(work_dir, f"translated_{language}.wav"))
+            for part_path in parts[language]:
+                os.remove(part_path)
+
+    return result
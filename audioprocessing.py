@@ -1,8 +1,11 @@
 import streamlit as st
-from azure.cognitiveservices.speech import SpeechConfig, SpeechRecognizer, AudioDataStream, SpeechSynthesizer
+from azure.cognitiveservices.speech import SpeechConfig, SpeechRecognizer, SpeechSynthesizer, ResultReason, CancellationReason
 from azure.cognitiveservices.speech.audio import AudioOutputConfig, AudioConfig
-import requests
-import json
+from audio_translation import TranslatorClient, translate_audio
+import threading
+import tempfile
+import shutil
+import time
 import os
 
 # Azure multi-service credentials
@@ -10,63 +13,110 @@ azure_key = os.environ["AZURE_AI_KEY"]
 service_region = os.environ["AZURE_AI_REGION"]
 azure_endpoint = os.environ["AZURE_AI_ENDPOINT"]
 
+# Default configuration
+TARGET_LANGUAGES = ["fr", "es", "de", "it", "pt", "ja", "zh-Hans", "en"]
+SYNTHESIS_LOCALES = {"fr": "fr-FR", "es": "es-ES", "de": "de-DE", "it": "it-IT", "pt": "pt-BR", "ja": "ja-JP", "zh-Hans": "zh-CN", "en": "en-US"}
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+WORK_ROOT = os.path.join(tempfile.gettempdir(), "audio_translation")
+SESSION_MAX_AGE = 24 * 60 * 60  # Seconds after which the directory of an inactive session is removed
+
+# Remove the directories of the sessions inactive for more than max_age
+def cleanup_work_dirs(work_root=WORK_ROOT, max_age=SESSION_MAX_AGE):
+    now = time.time()
+    for entry in os.scandir(work_root):
+        if entry.is_dir() and entry.name.startswith("session_") and now - entry.stat().st_mtime > max_age:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+# Transcribe the whole audio file with continuous recognition (recognize_once stops after the first utterance)
+def continuous_recognizer(audio_path):
+    def recognize(on_sentence):
+        speech_config = SpeechConfig(subscription=azure_key, endpoint=azure_endpoint)
+        audio_config = AudioConfig(filename=audio_path)
+        recognizer = SpeechRecognizer(speech_config=speech_config, audio_config=audio_config)
+        done = threading.Event()
+        errors = []
+
+        def recognized(evt):
+            if evt.result.reason == ResultReason.RecognizedSpeech:
+                on_sentence(evt.result.text)
+
+        def canceled(evt):
+            if evt.cancellation_details.reason == CancellationReason.Error:
+                errors.append(evt.cancellation_details.error_details)
+            done.set()
+
+        recognizer.recognized.connect(recognized)
+        recognizer.session_stopped.connect(lambda evt: done.set())
+        recognizer.canceled.connect(canceled)
+        recognizer.start_continuous_recognition()
+        done.wait()
+        recognizer.stop_continuous_recognition()
+        if errors:
+            raise RuntimeError(f"Transcription failed. Error: {errors[0]}")
+    return recognize
+
+# Convert text to audio using Azure Text-to-Speech, one synthesizer per call so they can run in parallel
+def synthesize(text, language, output_path):
+    speech_config = SpeechConfig(subscription=azure_key, endpoint=azure_endpoint)
+    speech_config.speech_synthesis_language = SYNTHESIS_LOCALES.get(language, language)
+    audio_config = AudioOutputConfig(filename=output_path)
+    synthesizer = SpeechSynthesizer(speech_config=speech_config, audio_config=audio_config)
+    result = synthesizer.speak_text_async(text).get()
+    del synthesizer  # Closes the output file
+    if result.reason != ResultReason.SynthesizingAudioCompleted:
+        raise RuntimeError(f"Speech synthesis failed: {result.reason}")
+    return output_path
+
 # Streamlit app
 st.title("Audio Translation App")
-st.write("Upload an audio file to transcribe, translate to French, and convert back to audio.")
+st.write("Upload an audio file to transcribe, translate, and convert back to audio.")
+
+# Per-session directory, so concurrent users do not overwrite each other's files
+if "work_dir" not in st.session_state or not os.path.isdir(st.session_state.work_dir):
+    os.makedirs(WORK_ROOT, exist_ok=True)
+    cleanup_work_dirs()
+    st.session_state.work_dir = tempfile.mkdtemp(prefix="session_", dir=WORK_ROOT)
+    st.session_state.result = None  # The files of a previous result were removed with its directory
+    st.session_state.result_key = None
+work_dir = st.session_state.work_dir
+
+languages = st.multiselect("Translate to:", TARGET_LANGUAGES, default=["fr"])
 
 # Upload audio file
 uploaded_file = st.file_uploader("Choose an audio file...", type=["wav", "mp3"])
 
-if uploaded_file is not None:
-    # Save the uploaded file
-    with open("uploaded_audio.wav", "wb") as f:
-        f.write(uploaded_file.getbuffer())
-    
-    # Transcribe audio using Azure Speech Service
-    speech_config = SpeechConfig(subscription=azure_key, endpoint=azure_endpoint)
-    audio_config = AudioConfig(filename="uploaded_audio.wav")
-    recognizer = SpeechRecognizer(speech_config=speech_config, audio_config=audio_config)
-    
-    st.write("Transcribing audio...")
-    result = recognizer.recognize_once()
-    
-    if result.reason == result.reason.RecognizedSpeech:
-        st.write("Transcription: ", result.text)
-        transcription = result.text
-        
-        # Translate text using Azure Translator Text API
-        st.write("Translating text...")
-        headers = {
-            "Ocp-Apim-Subscription-Key": azure_key,
-            "Ocp-Apim-Subscription-Region": service_region,  # Replace with your Azure region
-            "Content-Type": "application/json"
-        }
-        body = [{
-            "text": transcription
-        }]
-        translate_url = f"{azure_endpoint}/translator/text/v3.0/translate?to=fr"
-        
-        response = requests.post(translate_url, headers=headers, json=body)
-        if response.status_code == 200:
-            translation_result = response.json()
-            translated_text = translation_result[0]["translations"][0]["text"]
-            st.write("Translation: ", translated_text)
-            
-            # Convert translated text to audio using Azure Text-to-Speech
-            audio_config = AudioConfig(filename="translated_audio.wav")  # Use AudioConfig for output
-            synthesizer = SpeechSynthesizer(speech_config=speech_config, audio_config=audio_config)
-            
-            st.write("Converting translated text to audio...")
-            synthesizer.speak_text_async(translated_text).get()
-            
-            # Provide download link for the translated audio file
-            st.audio("translated_audio.wav", format="audio/wav")
-            # Provide a button to listen to the translated audio
-            if st.button("Play Translated Audio"):
-                st.audio("translated_audio.wav", format="audio/wav")
-                st.success("Playing translated audio!")
-            st.success("Translation and conversion completed successfully!")
+if uploaded_file is not None and languages:
+    # The result is kept in the session, so interacting with the page does not translate the file again
+    result_key = (getattr(uploaded_file, "file_id", f"{uploaded_file.name}_{uploaded_file.size}"), tuple(languages))
+    if st.session_state.get("result_key") != result_key:
+        # The new file replaces the files of the previous translation of the session
+        for entry in os.scandir(work_dir):
+            os.remove(entry.path)
+        # Save the uploaded file in chunks
+        audio_path = os.path.join(work_dir, f"uploaded_audio{os.path.splitext(uploaded_file.name)[1]}")
+        uploaded_file.seek(0)
+        with open(audio_path, "wb") as f:
+            shutil.copyfileobj(uploaded_file, f, UPLOAD_CHUNK_SIZE)
+
+        # Transcribe, translate in batches of sentences and synthesize the translations in parallel
+        translator = TranslatorClient(azure_endpoint, azure_key, service_region)
+        with st.spinner("Transcribing, translating and converting the translated text to audio..."):
+            try:
+                st.session_state.result = translate_audio(continuous_recognizer(audio_path), translator, synthesize, languages, work_dir)
+                st.session_state.result_key = result_key
+            except Exception as ex:
+                st.session_state.result = None
+                st.session_state.result_key = None
+                st.error(str(ex))
+
+    result = st.session_state.get("result")
+    if result is not None:
+        if not result.sentences:
+            st.error("Transcription failed.")
         else:
-            st.error("Translation failed. Error: " + response.text)
-    else:
-        st.error("Transcription failed.")
\ No newline at end of file
+            st.write("Transcription: ", result.transcription)
+            for language in languages:
+                st.write(f"Translation ({language}): ", result.translation(language))
+                # Provide the translated audio file
+                st.audio(result.audio_paths[language], format="audio/wav")
+            st.success("Translation and conversion completed successfully!")
@@ -0,0 +1,87 @@
+# Benchmark: individual frames vs frame mosaics (estimated tokens, payload size and, optionally, GPT-4o latency)
+import argparse
+import base64
+import time
+import cv2
+import numpy as np
+from dotenv import load_dotenv
+from frame_mosaic import pack_frames, uniform_timestamps, estimate_image_tokens, mosaic_prompt, DEFAULT_TILE_WIDTH
+
+USER_PROMPT = "These are the frames from the video."
+
+# Extract one frame every seconds_per_frame, resized by the resize ratio (as process_video in the apps)
+def extract_frames(video_path, seconds_per_frame, resize):
+    base64Frames = []
+    video = cv2.VideoCapture(video_path)
+    total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = video.get(cv2.CAP_PROP_FPS)
+    frames_to_skip = max(1, int(fps * seconds_per_frame))
+    curr_frame = 0
+    while curr_frame < total_frames - 1:
+        video.set(cv2.CAP_PROP_POS_FRAMES, curr_frame)
+        success, frame = video.read()
+        if not success:
+            break
+        if resize != 0:
+            height, width, _ = frame.shape
+            frame = cv2.resize(frame, (width // resize, height // resize))
+        _, buffer = cv2.imencode(".jpg", frame)
+        base64Frames.append(base64.b64encode(buffer).decode("utf-8"))
+        curr_frame += frames_to_skip
+    video.release()
+    return base64Frames
+
+def image_size(base64frame):
+    frame = cv2.imdecode(np.frombuffer(base64.b64decode(base64frame), dtype=np.uint8), cv2.IMREAD_COLOR)
+    height, width, _ = frame.shape
+    return width, height
+
+def summarize(name, images, elapsed):
+    tokens = sum(estimate_image_tokens(*image_size(x)) for x in images)
+    payload = sum(len(x) for x in images)
+    print(f"{name:<20} images: {len(images):>4}  estimated image tokens: {tokens:>7}  payload: {payload / 1024:>9.1f} KB  packing: {elapsed:.3f} s")
+
+# Send the images to GPT-4o and return the latency and the prompt tokens reported by the service
+def call_model(pool, images, user_prompt):
+    messages = [
+        {"role": "system", "content": "You are a helpful assistant that describes in detail a video."},
+        {"role": "user", "content": user_prompt},
+        {"role": "user", "content": [{"type": "image_url", "image_url": {"url": f'data:image/jpg;base64,{x}', "detail": "auto"}} for x in images]}
+    ]
+    start_time = time.time()
+    response = pool.call(lambda client, model: client.chat.completions.create(model=model, messages=messages, temperature=0, max_tokens=256))
+    return time.time() - start_time, response.usage.prompt_tokens
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare individual frames and frame mosaics")
+    parser.add_argument("video_path")
+    parser.add_argument("--seconds-per-frame", type=float, default=1)
+    parser.add_argument("--resize", type=int, default=0)
+    parser.add_argument("--frames-per-mosaic", type=int, nargs="+", default=[4, 9])
+    parser.add_argument("--tile-width", type=int, default=DEFAULT_TILE_WIDTH)
+    parser.add_argument("--call-model", action="store_true", help="Also send the images to GPT-4o (uses the .env configuration)")
+    args = parser.parse_args()
+
+    base64frames = extract_frames(args.video_path, args.seconds_per_frame, args.resize)
+    print(f"Extracted {len(base64frames)} frames from {args.video_path}")
+    timestamps = uniform_timestamps(len(base64frames), args.seconds_per_frame)
+
+    variants = [("individual frames", base64frames, 0.0, USER_PROMPT)]
+    for frames_per_mosaic in args.frames_per_mosaic:
+        start_time = time.time()
+        mosaics = pack_frames(base64frames, timestamps, frames_per_mosaic=frames_per_mosaic, tile_width=args.tile_width)
+        variants.append((f"mosaic of {frames_per_mosaic}", mosaics, time.time() - start_time, f"{USER_PROMPT} {mosaic_prompt(frames_per_mosaic)}"))
+
+    for name, images, elapsed, _ in variants:
+        summarize(name, images, elapsed)
+
+    if args.call_model:
+        load_dotenv(override=True)
+        from aoai_pool import create_aoai_pool
+        pool = create_aoai_pool()
+        for name, images, _, user_prompt in variants:
+            latency, prompt_tokens = call_model(pool, images, user_prompt)
+            print(f"{name:<20} latency: {latency:.3f} s  prompt tokens: {prompt_tokens}")
+
+if __name__ == "__main__":
+    main()
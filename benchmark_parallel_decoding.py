@@ -0,0 +1,38 @@
+# Benchmark: frame extraction time of one video with 1 to N decoding processes
+import argparse
+import os
+import time
+import cv2
+from parallel_decoding import decode_frames_parallel, warm_up
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the scaling of the parallel frame decoding")
+    parser.add_argument("video_path")
+    parser.add_argument("--seconds-per-frame", type=float, default=1)
+    parser.add_argument("--resize", type=int, default=0)
+    parser.add_argument("--max-workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per number of workers (the best one is reported)")
+    args = parser.parse_args()
+
+    video = cv2.VideoCapture(args.video_path)
+    total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = video.get(cv2.CAP_PROP_FPS)
+    video.release()
+    frame_indices = list(range(0, total_frames - 1, max(1, int(fps * args.seconds_per_frame))))
+    print(f"Decoding {len(frame_indices)} of {total_frames} frames from {args.video_path}")
+
+    baseline = None
+    for workers in range(1, args.max_workers + 1):
+        # Start the processes before measuring, as the apps keep the pool between segments
+        warm_up(workers)
+        best = None
+        for _ in range(args.repeat):
+            start_time = time.time()
+            buffers = decode_frames_parallel(args.video_path, frame_indices, resize=args.resize, workers=workers)
+            elapsed = time.time() - start_time
+            best = elapsed if best is None else min(best, elapsed)
+        baseline = baseline or best
+        print(f"workers: {workers:>3}  frames: {len(buffers):>5}  time: {best:.3f} s  speedup: {baseline / best:.2f}x")
+
+if __name__ == "__main__":
+    main()
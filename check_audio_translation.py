@@ -0,0 +1,83 @@
+# Check of the audio translation pipeline with local stand-ins of the speech and translator services
+import os
+import sys
+import time
+import wave
+import random
+import argparse
+import tempfile
+import threading
+from audio_translation import translate_audio
+
+SAMPLE_RATE = 16000
+SAMPLES_PER_CHAR = 160  # Length of the synthesized speech: 10 ms per character
+
+# Stand-in of the continuous recognition: one sentence every sentence_interval seconds
+def make_recognizer(sentences, sentence_interval):
+    def recognize(on_sentence):
+        for sentence in sentences:
+            time.sleep(sentence_interval)
+            on_sentence(sentence)
+    return recognize
+
+# Stand-in of the Translator: tags each text with its language, with a random latency per request
+class StandInTranslator:
+    def __init__(self, latency):
+        self.latency = latency
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def translate(self, texts, languages):
+        with self.lock:
+            self.requests += 1
+        time.sleep(random.uniform(0, self.latency))
+        return [{language: f"[{language}] {text}" for language in languages} for text in texts]
+
+# Stand-in of the speech synthesis: silence proportional to the length of the text
+def make_synthesizer(latency):
+    def synthesize(text, language, output_path):
+        time.sleep(random.uniform(0, latency))
+        with wave.open(output_path, "wb") as output:
+            output.setnchannels(1)
+            output.setsampwidth(2)
+            output.setframerate(SAMPLE_RATE)
+            output.writeframes(bytes(2 * SAMPLES_PER_CHAR * len(text)))
+    return synthesize
+
+def check(condition, message):
+    if not condition:
+        print(f"FAILED: {message}")
+        sys.exit(1)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the audio translation pipeline with local stand-ins of the Azure services")
+    parser.add_argument("--sentences", type=int, default=200)
+    parser.add_argument("--languages", nargs="+", default=["es", "fr", "de"])
+    parser.add_argument("--batch-sentences", type=int, default=25)
+    parser.add_argument("--sentence-interval", type=float, default=0.002, help="Seconds between two recognized sentences")
+    parser.add_argument("--latency", type=float, default=0.05, help="Highest random latency of the translator and synthesis stand-ins, in seconds")
+    args = parser.parse_args()
+
+    sentences = [f"Sentence number {i} of the recognized audio." for i in range(args.sentences)]
+    translator = StandInTranslator(args.latency)
+    with tempfile.TemporaryDirectory() as work_dir:
+        start_time = time.time()
+        result = translate_audio(make_recognizer(sentences, args.sentence_interval), translator, make_synthesizer(args.latency),
+                                 args.languages, work_dir, batch_sentences=args.batch_sentences)
+        elapsed = time.time() - start_time
+
+        # The transcription, the translations and the audio keep the order of the recognition
+        check(result.sentences == sentences, "the recognized sentences are not in order")
+        for language in args.languages:
+            check(result.translations[language] == [f"[{language}] {sentence}" for sentence in sentences], f"the {language} translations are not in order")
+            with wave.open(result.audio_paths[language], "rb") as audio:
+                frames = audio.getnframes()
+            batches = [sentences[i:i + args.batch_sentences] for i in range(0, len(sentences), args.batch_sentences)]
+            expected = sum(SAMPLES_PER_CHAR * len(" ".join(f"[{language}] {s}" for s in batch)) for batch in batches)
+            check(frames == expected, f"the {language} audio has {frames} frames instead of {expected}")
+        check(sorted(os.listdir(work_dir)) == sorted(f"translated_{language}.wav" for language in args.languages), "the audio parts were not removed")
+
+    print(f"OK: {len(sentences)} sentences translated to {len(args.languages)} languages in {translator.requests} translator requests, {elapsed:.2f} s")
+
+if __name__ == "__main__":
+    main()
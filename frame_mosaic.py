@@ -0,0 +1,80 @@
+# Pack consecutive frames into mosaic images to reduce the per-image token overhead of GPT-4o
+import math
+import base64
+import cv2
+import numpy as np
+
+# Default configuration
+DEFAULT_FRAMES_PER_MOSAIC = 4  # 2x2 grid
+DEFAULT_TILE_WIDTH = 512  # Width of each frame inside the mosaic, in pixels
+MOSAIC_PROMPT = "Each image is a grid of {frames_per_mosaic} consecutive frames of the video, ordered left to right and top to bottom, with the timestamp of each frame in its top-left corner."
+
+# Estimation of the tokens of an image with detail "high"/"auto" for GPT-4o:
+# the image is scaled to fit 2048x2048, then its shortest side to 768, and each 512px tile costs 170 tokens plus 85 base tokens
+def estimate_image_tokens(width, height, detail="auto"):
+    if detail == "low":
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    return 85 + 170 * math.ceil(width / 512) * math.ceil(height / 512)
+
+def format_timestamp(seconds):
+    # Round to tenths of a second first, so 59.96 s is 01:00.0 and not 00:60.0
+    minutes, tenths = divmod(round(seconds * 10), 600)
+    seconds = tenths / 10
+    if minutes >= 60: # Segments of long videos
+        hours, minutes = divmod(minutes, 60)
+        return f"{int(hours)}:{int(minutes):02d}:{seconds:04.1f}"
+    return f"{int(minutes):02d}:{seconds:04.1f}"
+
+# Decode base64 JPG frames and resize them to the same tile size
+def decode_frames(base64frames, tile_width=DEFAULT_TILE_WIDTH):
+    frames = [cv2.imdecode(np.frombuffer(base64.b64decode(x), dtype=np.uint8), cv2.IMREAD_COLOR) for x in base64frames]
+    height, width, _ = frames[0].shape
+    tile_width = min(tile_width, width)  # Do not upscale small frames
+    tile_height = max(1, round(height * tile_width / width))
+    return np.stack([cv2.resize(frame, (tile_width, tile_height), interpolation=cv2.INTER_AREA) for frame in frames])
+
+# Tile N frames of shape (N, h, w, 3) into a grid of rows x cols, padding the missing cells with black
+def tile_frames(tiles, cols):
+    count, height, width, channels = tiles.shape
+    rows = math.ceil(count / cols)
+    padding = rows * cols - count
+    if padding:
+        tiles = np.concatenate([tiles, np.zeros((padding, height, width, channels), dtype=tiles.dtype)])
+    return tiles.reshape(rows, cols, height, width, channels).transpose(0, 2, 1, 3, 4).reshape(rows * height, cols * width, channels)
+
+def burn_timestamp(tile, text):
+    scale = max(0.4, tile.shape[1] / 640)
+    thickness = max(1, round(scale * 2))
+    (text_width, text_height), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, scale, thickness)
+    cv2.rectangle(tile, (0, 0), (text_width + 8, text_height + baseline + 8), (0, 0, 0), -1)
+    cv2.putText(tile, text, (4, text_height + 4), cv2.FONT_HERSHEY_SIMPLEX, scale, (255, 255, 255), thickness, cv2.LINE_AA)
+
+# Pack the frames in groups of frames_per_mosaic consecutive frames. timestamps are the seconds of each frame in the video
+def pack_frames(base64frames, timestamps, frames_per_mosaic=DEFAULT_FRAMES_PER_MOSAIC, tile_width=DEFAULT_TILE_WIDTH):
+    if not base64frames or frames_per_mosaic <= 1:
+        return base64frames
+
+    tiles = decode_frames(base64frames, tile_width)
+    for tile, timestamp in zip(tiles, timestamps):
+        burn_timestamp(tile, format_timestamp(timestamp))
+
+    cols = math.ceil(math.sqrt(frames_per_mosaic))
+    mosaics = []
+    for start in range(0, len(tiles), frames_per_mosaic):
+        mosaic = tile_frames(tiles[start:start + frames_per_mosaic], cols)
+        _, buffer = cv2.imencode(".jpg", mosaic)
+        mosaics.append(base64.b64encode(buffer).decode("utf-8"))
+    print(f"Packed {len(base64frames)} frames into {len(mosaics)} mosaics")
+
+    return mosaics
+
+# Timestamps of the frames sampled uniformly every seconds_per_frame
+def uniform_timestamps(count, seconds_per_frame):
+    return [i * seconds_per_frame for i in range(count)]
+
+def mosaic_prompt(frames_per_mosaic):
+    return MOSAIC_PROMPT.format(frames_per_mosaic=frames_per_mosaic)
@@ -0,0 +1,102 @@
+# Persistent store of the extracted frames of a video: one append-only pack file with the JPGs
+# and a memory-mapped index of (frame, timestamp, offset, length, perceptual hash) records
+import os
+import mmap
+import hashlib
+import threading
+import cv2
+import numpy as np
+try:
+    import fcntl
+except ImportError: # Windows: only the threads of this process are serialized
+    fcntl = None
+
+INDEX_DTYPE = np.dtype([
+    ("frame", "<u8"),
+    ("timestamp", "<f8"),
+    ("offset", "<u8"),
+    ("length", "<u8"),
+    ("phash", "<u8"),
+])
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# The Streamlit sessions are threads of one process and can append to the same store at the same time
+_append_locks = {}
+_append_locks_guard = threading.Lock()
+
+def append_lock(path):
+    with _append_locks_guard:
+        return _append_locks.setdefault(os.path.abspath(path), threading.Lock())
+
+# Content hash of the video, so different videos with the same file name do not share a store
+def video_digest(video_path):
+    digest = hashlib.sha256()
+    with open(video_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:16]
+
+# 64-bit difference hash of a JPG, decoded at 1/8 of its size in grayscale
+def perceptual_hash(buffer):
+    image = cv2.imdecode(np.frombuffer(buffer, dtype=np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    image = cv2.resize(image, (9, 8), interpolation=cv2.INTER_AREA)
+    bits = np.packbits(image[:, 1:] > image[:, :-1])
+    return int.from_bytes(bits.tobytes(), "big")
+
+class FrameStore:
+    def __init__(self, directory, key):
+        os.makedirs(directory, exist_ok=True)
+        self.pack_path = os.path.join(directory, f"{key}.pack")
+        self.index_path = os.path.join(directory, f"{key}.idx")
+
+    # One store per video content and resize ratio
+    @classmethod
+    def for_video(cls, directory, video_path, resize):
+        name = os.path.splitext(os.path.basename(video_path))[0]
+        return cls(directory, f"{name}_{video_digest(video_path)}_resize{resize}")
+
+    # Memory-mapped view of the index records
+    def index(self):
+        size = os.path.getsize(self.index_path) if os.path.exists(self.index_path) else 0
+        count = size // INDEX_DTYPE.itemsize
+        if count == 0:
+            return np.zeros(0, dtype=INDEX_DTYPE)
+        return np.memmap(self.index_path, dtype=INDEX_DTYPE, mode="r", shape=(count,))
+
+    # Append (frame, timestamp, buffer) tuples. The index is written after the pack,
+    # so an interrupted write leaves unreferenced bytes in the pack but never a broken index.
+    # Appends are serialized (threads and processes) and the offsets are taken once the lock is held
+    def append(self, frames):
+        if not frames:
+            return
+        records = np.zeros(len(frames), dtype=INDEX_DTYPE)
+        data = [bytes(buffer) for _, _, buffer in frames]
+        records["frame"] = [frame for frame, _, _ in frames]
+        records["timestamp"] = [timestamp for _, timestamp, _ in frames]
+        records["length"] = [len(buffer) for buffer in data]
+        records["phash"] = [perceptual_hash(buffer) for buffer in data]
+        with append_lock(self.pack_path), open(self.pack_path, "ab") as pack:
+            if fcntl is not None:
+                fcntl.flock(pack.fileno(), fcntl.LOCK_EX) # Released when the file is closed
+            pack.seek(0, os.SEEK_END)
+            records["offset"] = pack.tell() + np.cumsum(records["length"]) - records["length"]
+            for buffer in data:
+                pack.write(buffer)
+            pack.flush()
+            with open(self.index_path, "ab") as index:
+                index.write(records.tobytes())
+
+    # Read the JPGs of the stored frames with the given indices. Returns a dict {frame: bytes}
+    def read(self, frame_indices):
+        index = self.index()
+        if len(index) == 0 or not os.path.exists(self.pack_path) or os.path.getsize(self.pack_path) == 0:
+            return {}
+        positions = dict(zip(index["frame"].tolist(), range(len(index))))
+        rows = [positions[frame] for frame in frame_indices if frame in positions]
+        if not rows:
+            return {}
+        with open(self.pack_path, "rb") as pack, mmap.mmap(pack.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return {int(index["frame"][row]): data[int(index["offset"][row]):int(index["offset"][row] + index["length"][row])] for row in rows}
+
+    def __len__(self):
+        return len(self.index())
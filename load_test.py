@@ -0,0 +1,143 @@
+# Load test of the segment pipeline (Whisper transcription + GPT-4o analysis) against local mock servers
+import time
+import base64
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+from aoai_pool import Deployment, DeploymentPool, estimate_chat_tokens
+from prompt_cache import build_messages, usage_tokens, CacheReport
+from response_stream import consume_stream, stream_metrics
+from mock_aoai_server import start_mock_server, add_config_arguments, config_from_arguments
+
+SYSTEM_PROMPT = "You are an expert on Video Analysis. You will be shown a series of images from a video. Describe what is happening in the video, including the objects, actions, and any other relevant details. Be as specific and detailed as possible."
+USER_PROMPT = "These are the frames from the video."
+API_VERSION = "2024-10-21"
+
+# Latencies and errors of each kind of request
+class LoadTestStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {"transcription": [], "analysis": []}
+        self.errors = {"transcription": 0, "analysis": 0}
+        self.attempts = 0
+        self.segments = 0
+        self.cache_report = CacheReport()
+
+    def record(self, kind, latency=None, error=False):
+        with self.lock:
+            if error:
+                self.errors[kind] += 1
+            else:
+                self.latencies[kind].append(latency)
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+# Random frames encoded as JPG, as process_video would send them
+def synthetic_frames(count, width, height):
+    frames = []
+    for _ in range(count):
+        frame = np.random.randint(0, 256, (height // 8, width // 8, 3), dtype=np.uint8)
+        frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_LINEAR)
+        _, buffer = cv2.imencode(".jpg", frame)
+        frames.append(base64.b64encode(buffer).decode("utf-8"))
+    return frames
+
+# One segment of the pipeline: transcription of its audio and analysis of its frames
+def run_segment(aoai_pool, whisper_pool, stats, base64frames, audio, stream):
+    def counted(call):
+        def attempt(client, model):
+            with stats.lock:
+                stats.attempts += 1
+            return call(client, model)
+        return attempt
+
+    start_time = time.time()
+    try:
+        transcription = whisper_pool.call(counted(lambda client, model: client.audio.transcriptions.create(model=model, file=("segment.mp3", audio))), tokens=len(audio)).text
+        stats.record("transcription", time.time() - start_time)
+    except Exception:
+        stats.record("transcription", error=True)
+        transcription = ''
+
+    messages = build_messages(SYSTEM_PROMPT, USER_PROMPT, base64frames, transcription)
+    start_time = time.time()
+    try:
+        if stream:
+            _, metrics = aoai_pool.call(counted(lambda client, model: consume_stream(
+                client.chat.completions.create(model=model, messages=messages, temperature=0.5, max_tokens=4096, stream=True, stream_options={"include_usage": True}),
+                start_time
+            )), tokens=estimate_chat_tokens(messages, max_tokens=4096))
+        else:
+            response = aoai_pool.call(counted(lambda client, model: client.chat.completions.create(model=model, messages=messages, temperature=0.5, max_tokens=4096)),
+                                      tokens=estimate_chat_tokens(messages, max_tokens=4096))
+            end_time = time.time()
+            metrics = stream_metrics(start_time, end_time, end_time, response.usage.completion_tokens, *usage_tokens(response.usage))
+        stats.record("analysis", time.time() - start_time)
+        with stats.lock:
+            stats.cache_report.add(metrics)
+    except Exception:
+        stats.record("analysis", error=True)
+    with stats.lock:
+        stats.segments += 1
+
+# Each segment has its own frames, so only the static prompts can be cached
+def run_session(aoai_pool, whisper_pool, stats, segments, frames, frame_width, frame_height, audio, stream):
+    for _ in range(segments):
+        base64frames = synthetic_frames(frames, frame_width, frame_height)
+        run_segment(aoai_pool, whisper_pool, stats, base64frames, audio, stream)
+
+def report(stats, elapsed, servers, pools):
+    print(f"\nSegments: {stats.segments} in {elapsed:.2f} s ({stats.segments / elapsed:.2f} segments/s)")
+    requests = sum(len(latencies) for latencies in stats.latencies.values()) + sum(stats.errors.values())
+    print(f"Requests: {requests} ({requests / elapsed:.2f} requests/s), attempts including failovers: {stats.attempts}")
+    for kind, latencies in stats.latencies.items():
+        total = len(latencies) + stats.errors[kind]
+        error_rate = stats.errors[kind] / total if total else 0.0
+        p50, p99 = percentile(latencies, 50), percentile(latencies, 99)
+        print(f"{kind:<14} requests: {total:>5}  p50: {p50 or 0:.3f} s  p99: {p99 or 0:.3f} s  error rate: {error_rate:.1%}")
+    print(stats.cache_report)
+    for i, server in enumerate(servers):
+        print(f"Mock deployment {i}: requests: {server.stats.requests}, throttled: {server.stats.throttled}, server errors: {server.stats.server_errors}")
+    for name, pool in pools.items():
+        for status in pool.status():
+            print(f"{name} pool: {status['endpoint']} consecutive failures: {status['failures']}, available: {status['available']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the segment pipeline against local mock Azure OpenAI servers")
+    parser.add_argument("--sessions", type=int, default=4, help="Simulated sessions running at the same time")
+    parser.add_argument("--segments", type=int, default=5, help="Segments per session")
+    parser.add_argument("--frames", type=int, default=10, help="Frames per segment")
+    parser.add_argument("--frame-width", type=int, default=960)
+    parser.add_argument("--frame-height", type=int, default=540)
+    parser.add_argument("--audio-kb", type=int, default=80, help="Size of the audio of each segment")
+    parser.add_argument("--deployments", type=int, default=1, help="Mock deployments behind the pool")
+    parser.add_argument("--stream", action="store_true", help="Stream the analysis")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    config = config_from_arguments(args)
+    servers = [start_mock_server(config) for _ in range(args.deployments)]
+    aoai_pool = DeploymentPool([Deployment(server.endpoint, "mock-key", API_VERSION, "gpt-4o") for server in servers])
+    whisper_pool = DeploymentPool([Deployment(server.endpoint, "mock-key", API_VERSION, "whisper") for server in servers])
+
+    audio = bytes(args.audio_kb * 1024)
+    stats = LoadTestStats()
+    print(f"Running {args.sessions} sessions x {args.segments} segments, {args.frames} frames of {args.frame_width}x{args.frame_height} per segment, {args.deployments} deployments")
+
+    start_time = time.time()
+    with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+        for _ in range(args.sessions):
+            executor.submit(run_session, aoai_pool, whisper_pool, stats, args.segments, args.frames, args.frame_width, args.frame_height, audio, args.stream)
+    report(stats, time.time() - start_time, servers, {"GPT-4o": aoai_pool, "Whisper": whisper_pool})
+
+    for server in servers:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
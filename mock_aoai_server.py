@@ -0,0 +1,258 @@
+# Local mock of the Azure OpenAI endpoints used by the apps (chat completions and audio transcriptions),
+# to tune concurrency and batch sizes without consuming quota.
+# Point AZURE_OPENAI_ENDPOINT / WHISPER_ENDPOINT (or the *_DEPLOYMENTS lists) to http://127.0.0.1:<port>/
+import re
+import json
+import time
+import math
+import random
+import base64
+import hashlib
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from frame_mosaic import estimate_image_tokens
+from prompt_cache import CACHE_MIN_PREFIX_TOKENS
+
+CHARS_PER_TOKEN = 4
+CACHE_BLOCK_TOKENS = 128
+SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+# Behaviour of the mock service
+class MockConfig:
+    def __init__(self, latency_median=0.5, latency_sigma=0.3, seconds_per_prompt_token=0.00005, token_interval=0.005,
+                 completion_tokens=200, transcription_seconds_per_mb=0.5, error_rate_429=0.0, error_rate_5xx=0.0, retry_after=1):
+        self.latency_median = latency_median  # Median of the log-normal base latency, in seconds
+        self.latency_sigma = latency_sigma
+        self.seconds_per_prompt_token = seconds_per_prompt_token  # Prompt processing time before the first token
+        self.token_interval = token_interval  # Seconds between two generated tokens
+        self.completion_tokens = completion_tokens
+        self.transcription_seconds_per_mb = transcription_seconds_per_mb
+        self.error_rate_429 = error_rate_429
+        self.error_rate_5xx = error_rate_5xx
+        self.retry_after = retry_after
+
+    def base_latency(self):
+        if self.latency_median <= 0:
+            return 0.0
+        return random.lognormvariate(math.log(self.latency_median), self.latency_sigma)
+
+# Width and height of a JPG, read from its SOF segment
+def jpeg_size(data):
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            i += 1
+            continue
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7:
+            i += 2
+            continue
+        if marker in SOF_MARKERS:
+            return int.from_bytes(data[i + 7:i + 9], "big"), int.from_bytes(data[i + 5:i + 7], "big")
+        i += 2 + int.from_bytes(data[i + 2:i + 4], "big")
+    return None
+
+def image_tokens(part):
+    image_url = part["image_url"]
+    detail = image_url.get("detail", "auto")
+    url = image_url["url"]
+    size = None
+    if url.startswith("data:"):
+        size = jpeg_size(base64.b64decode(url.split(",", 1)[1]))
+    if size is None:
+        return estimate_image_tokens(512, 512, detail)
+    return estimate_image_tokens(*size, detail)
+
+def message_tokens(message):
+    content = message["content"]
+    if isinstance(content, str):
+        return 4 + len(content) // CHARS_PER_TOKEN
+    tokens = 4
+    for part in content:
+        if part["type"] == "image_url":
+            tokens += image_tokens(part)
+        else:
+            tokens += len(part.get("text", "")) // CHARS_PER_TOKEN
+    return tokens
+
+# Emulation of the prompt cache: the longest previously seen prefix of messages is cached (from 1024 tokens, in blocks of 128)
+class PromptCache:
+    def __init__(self):
+        self.prefixes = set()
+        self.lock = threading.Lock()
+
+    def lookup(self, messages, tokens_per_message):
+        digest = hashlib.sha256()
+        prefix_tokens = 0
+        cached = 0
+        with self.lock:
+            for message, tokens in zip(messages, tokens_per_message):
+                digest.update(json.dumps(message, sort_keys=True).encode("utf-8"))
+                prefix_tokens += tokens
+                key = digest.hexdigest()
+                if key in self.prefixes:
+                    cached = prefix_tokens
+                self.prefixes.add(key)
+        if cached < CACHE_MIN_PREFIX_TOKENS:
+            return 0
+        return cached // CACHE_BLOCK_TOKENS * CACHE_BLOCK_TOKENS
+
+# Counters of the requests served, for the reports of the load test
+class MockStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.throttled = 0
+        self.server_errors = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+        self.completion_tokens = 0
+
+    def add(self, **counters):
+        with self.lock:
+            for name, value in counters.items():
+                setattr(self, name, getattr(self, name) + value)
+
+class MockHandler(BaseHTTPRequestHandler):
+    config = None
+    stats = None
+    cache = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    # Random 429/5xx errors. Returns True if an error was sent
+    def inject_error(self):
+        value = random.random()
+        if value < self.config.error_rate_429:
+            self.stats.add(requests=1, throttled=1)
+            self.send_json(429, {"error": {"code": "429", "message": "Rate limit is exceeded (mock)."}}, {"Retry-After": str(self.config.retry_after)})
+            return True
+        if value < self.config.error_rate_429 + self.config.error_rate_5xx:
+            self.stats.add(requests=1, server_errors=1)
+            self.send_json(500, {"error": {"code": "InternalServerError", "message": "Internal server error (mock)."}})
+            return True
+        return False
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        match = re.match(r"^/openai/deployments/([^/]+)/(chat/completions|audio/transcriptions)", self.path)
+        if match is None:
+            self.send_json(404, {"error": {"code": "404", "message": f"Unknown path {self.path}"}})
+            return
+        if self.inject_error():
+            return
+        if match.group(2) == "chat/completions":
+            self.chat_completions(match.group(1), json.loads(body))
+        else:
+            self.transcriptions(body)
+
+    def chat_completions(self, deployment, request):
+        messages = request["messages"]
+        tokens_per_message = [message_tokens(message) for message in messages]
+        prompt_tokens = sum(tokens_per_message)
+        cached_tokens = self.cache.lookup(messages, tokens_per_message)
+        completion_tokens = min(request.get("max_tokens") or self.config.completion_tokens, self.config.completion_tokens)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+        }
+        self.stats.add(requests=1, prompt_tokens=prompt_tokens, cached_tokens=cached_tokens, completion_tokens=completion_tokens)
+
+        # Cached tokens are not processed again
+        time.sleep(self.config.base_latency() + (prompt_tokens - cached_tokens) * self.config.seconds_per_prompt_token)
+        created = int(time.time())
+        if not request.get("stream"):
+            time.sleep(completion_tokens * self.config.token_interval)
+            self.send_json(200, {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": created,
+                "model": deployment,
+                "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "mock " * completion_tokens}}],
+                "usage": usage,
+            })
+            return
+
+        # Server-sent events, one token per chunk
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        def send_chunk(choices, chunk_usage=None):
+            chunk = {"id": "chatcmpl-mock", "object": "chat.completion.chunk", "created": created, "model": deployment, "choices": choices}
+            if chunk_usage is not None:
+                chunk["usage"] = chunk_usage
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+        for _ in range(completion_tokens):
+            send_chunk([{"index": 0, "delta": {"content": "mock "}, "finish_reason": None}])
+            time.sleep(self.config.token_interval)
+        send_chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        if (request.get("stream_options") or {}).get("include_usage"):
+            send_chunk([], usage)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def transcriptions(self, body):
+        self.stats.add(requests=1)
+        time.sleep(self.config.base_latency() + len(body) / (1024 * 1024) * self.config.transcription_seconds_per_mb)
+        self.send_json(200, {"text": "This is a mock transcription of the audio."})
+
+# Start a mock server in a background thread. Returns the server (server.stats has the counters)
+def start_mock_server(config=None, host="127.0.0.1", port=0):
+    handler = type("ConfiguredMockHandler", (MockHandler,), {"config": config or MockConfig(), "stats": MockStats(), "cache": PromptCache()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.stats = handler.stats
+    server.endpoint = f"http://{host}:{server.server_address[1]}/"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def add_config_arguments(parser):
+    parser.add_argument("--latency-median", type=float, default=0.5, help="Median base latency of the requests, in seconds (log-normal)")
+    parser.add_argument("--latency-sigma", type=float, default=0.3, help="Sigma of the log-normal base latency")
+    parser.add_argument("--token-interval", type=float, default=0.005, help="Seconds between generated tokens")
+    parser.add_argument("--completion-tokens", type=int, default=200)
+    parser.add_argument("--error-rate-429", type=float, default=0.0, help="Share of requests answered with 429")
+    parser.add_argument("--error-rate-5xx", type=float, default=0.0, help="Share of requests answered with 500")
+    parser.add_argument("--retry-after", type=int, default=1, help="Retry-After header of the 429 responses, in seconds")
+
+def config_from_arguments(args):
+    return MockConfig(latency_median=args.latency_median, latency_sigma=args.latency_sigma, token_interval=args.token_interval,
+                      completion_tokens=args.completion_tokens, error_rate_429=args.error_rate_429, error_rate_5xx=args.error_rate_5xx,
+                      retry_after=args.retry_after)
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Azure OpenAI server (chat completions and audio transcriptions)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    server = start_mock_server(config_from_arguments(args), args.host, args.port)
+    print(f"Mock Azure OpenAI server listening on {server.endpoint}")
+    try:
+        while True:
+            time.sleep(10)
+            print(f"requests: {server.stats.requests}, throttled: {server.stats.throttled}, server errors: {server.stats.server_errors}, prompt tokens: {server.stats.prompt_tokens}, cached tokens: {server.stats.cached_tokens}")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+# Motion-adaptive frame sampling: spend a fixed frame budget on the moments of the video with more changes
+import cv2
+import numpy as np
+
+# Default configuration
+DEFAULT_FRAME_BUDGET = 10  # Frames per segment
+ANALYSIS_WIDTH = 64  # Width of the grayscale thumbnails used to score the motion
+ANALYSIS_FPS = 5  # Thumbnails decoded per second of video to score the motion
+UNIFORM_SHARE = 0.2  # Share of the budget spread uniformly, so static parts of the video are not left without frames
+
+# Decode the video at low resolution and return the frame indices of the thumbnails and their grayscale pixels (N, h, w)
+def decode_thumbnails(video_path, analysis_width=ANALYSIS_WIDTH, analysis_fps=ANALYSIS_FPS):
+    video = cv2.VideoCapture(video_path)
+    total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
+    fps = video.get(cv2.CAP_PROP_FPS)
+    step = max(1, int(fps / analysis_fps))
+
+    indices = []
+    thumbnails = []
+    for curr_frame in range(total_frames):
+        # grab() still decodes every frame, but retrieve() (the copy and colour conversion) is only done for the scored ones
+        if not video.grab():
+            break
+        if curr_frame % step != 0:
+            continue
+        success, frame = video.retrieve()
+        if not success:
+            break
+        height, width, _ = frame.shape
+        thumbnail = cv2.resize(frame, (analysis_width, max(1, height * analysis_width // width)), interpolation=cv2.INTER_AREA)
+        thumbnails.append(cv2.cvtColor(thumbnail, cv2.COLOR_BGR2GRAY))
+        indices.append(curr_frame)
+    video.release()
+
+    return np.array(indices), np.stack(thumbnails) if thumbnails else np.zeros((0, 1, 1), dtype=np.uint8)
+
+# Motion score of each thumbnail: mean absolute difference with the previous one (the first one gets the mean score)
+def motion_scores(thumbnails):
+    if len(thumbnails) < 2:
+        return np.ones(len(thumbnails))
+    diffs = np.abs(np.diff(thumbnails.astype(np.int16), axis=0)).mean(axis=(1, 2))
+    return np.concatenate([[diffs.mean()], diffs])
+
+# Cap the weights (summing 1) at the share of one frame, moving the excess to the other weights,
+# so a single large score (e.g. a hard cut) does not take several frames of the budget
+def cap_weights(weights, frame_budget):
+    cap = 1 / frame_budget
+    for _ in range(frame_budget):
+        capped = weights >= cap
+        excess = (weights[capped] - cap).sum()
+        if excess <= 0 or capped.all():
+            break
+        weights = np.where(capped, cap, weights + excess * weights / weights[~capped].sum())
+    return weights
+
+# Add the middle of the largest gaps between the selected positions until there are frame_budget positions
+def fill_gaps(positions, count, frame_budget):
+    selected = set(positions.tolist())
+    while len(selected) < frame_budget:
+        bounds = [-1] + sorted(selected) + [count]
+        gaps = np.diff(bounds)
+        largest = int(np.argmax(gaps))
+        selected.add((bounds[largest] + bounds[largest + 1]) // 2)
+    return np.array(sorted(selected))
+
+# Pick frame_budget positions so that each one covers the same amount of cumulative motion
+def select_by_motion(scores, frame_budget, uniform_share=UNIFORM_SHARE):
+    count = len(scores)
+    if count <= frame_budget:
+        return np.arange(count)
+    total = scores.sum()
+    weights = scores / total if total > 0 else np.zeros(count)
+    weights = cap_weights((1 - uniform_share) * weights + uniform_share / count, frame_budget)
+    cumulative = np.cumsum(weights)
+    targets = (np.arange(frame_budget) + 0.5) / frame_budget
+    positions = np.unique(np.minimum(np.searchsorted(cumulative, targets * cumulative[-1]), count - 1))
+    # Rounding can still merge two targets in one position: spend the rest of the budget on the largest gaps
+    return fill_gaps(positions, count, frame_budget)
+
+# Frame indices of the video to extract with the motion-adaptive strategy
+def motion_frame_indices(video_path, frame_budget=DEFAULT_FRAME_BUDGET, analysis_width=ANALYSIS_WIDTH, analysis_fps=ANALYSIS_FPS):
+    indices, thumbnails = decode_thumbnails(video_path, analysis_width, analysis_fps)
+    if len(indices) == 0:
+        return []
+    selected = indices[select_by_motion(motion_scores(thumbnails), frame_budget)]
+    print(f"Selected {len(selected)} of {len(indices)} scored frames by motion")
+    return selected.tolist()
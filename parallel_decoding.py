@@ -0,0 +1,153 @@
+# Decode the frames of one video in several processes, each one with its own cv2.VideoCapture
+import os
+import sys
+import types
+import threading
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
+import cv2
+
+# Default configuration
+DEFAULT_DECODE_WORKERS = max(1, min(4, os.cpu_count() or 1))
+SEEK_THRESHOLD = 30  # Frames: closer frames are reached reading sequentially instead of seeking
+
+_executors = {}  # One pool of processes per number of workers, shared by all the sessions
+_executors_lock = threading.Lock()
+
+# Decode the frames of one time range of the video and return their JPG bytes
+def decode_buffers(video_path, frame_indices, resize):
+    video = cv2.VideoCapture(video_path)
+    buffers = []
+    position = -1
+    for curr_frame in frame_indices:
+        if position < 0 or curr_frame < position or curr_frame - position > SEEK_THRESHOLD:
+            video.set(cv2.CAP_PROP_POS_FRAMES, curr_frame)
+        else:
+            # Reading on is cheaper than seeking for close frames: grab() decodes the skipped frames but does not retrieve them
+            for _ in range(curr_frame - position):
+                video.grab()
+        success, frame = video.read()
+        if not success:
+            break
+        position = curr_frame + 1
+
+        # Resize the frame to save tokens and get faster answer from the model. If resize==0 don't resize
+        if resize != 0:
+            height, width, _ = frame.shape
+            frame = cv2.resize(frame, (width // resize, height // resize))
+
+        _, buffer = cv2.imencode(".jpg", frame)
+        buffers.append(buffer.tobytes())
+    video.release()
+
+    return buffers
+
+# Worker: decode one time range and write the JPGs to a shared memory block.
+# Only the name of the block and the (offset, length) of each frame are sent back to the main process
+def decode_range(video_path, frame_indices, resize):
+    buffers = decode_buffers(video_path, frame_indices, resize)
+    size = sum(len(buffer) for buffer in buffers)
+    if size == 0:
+        return None, []
+    block = shared_memory.SharedMemory(create=True, size=size)
+    layout = []
+    offset = 0
+    for buffer in buffers:
+        block.buf[offset:offset + len(buffer)] = buffer
+        layout.append((offset, len(buffer)))
+        offset += len(buffer)
+    name = block.name
+    block.close()  # The main process unlinks the block after reading it
+
+    return name, layout
+
+# Copy the frames out of a shared memory block and release it
+def read_block(name, layout):
+    if name is None:
+        return []
+    block = shared_memory.SharedMemory(name=name)
+    try:
+        return [bytes(block.buf[offset:offset + length]) for offset, length in layout]
+    finally:
+        block.close()
+        block.unlink()
+
+# The pools of processes are kept between segments, so the processes start only once.
+# "spawn" avoids forking the threads of the Streamlit server. Must be called with _executors_lock held
+def get_executor(workers):
+    if workers not in _executors:
+        _executors[workers] = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return _executors[workers]
+
+# The spawned processes import the __main__ module of the parent. Under Streamlit it is the app script,
+# which would run again in every worker, so the processes are started with an empty __main__ instead
+@contextlib.contextmanager
+def worker_safe_main():
+    main = sys.modules["__main__"]
+    sys.modules["__main__"] = types.ModuleType("__main__")
+    try:
+        yield
+    finally:
+        sys.modules["__main__"] = main
+
+# Start all the processes of the pool of workers. submit() spawns a process while no worker is idle,
+# so the processes start before the tasks of the first segment are submitted
+def warm_up(workers):
+    if workers <= 1:
+        return
+    with _executors_lock, worker_safe_main():
+        futures = [get_executor(workers).submit(os.getpid) for _ in range(workers)]
+    for future in futures:
+        future.result()
+
+# Split the sorted frame indices into one contiguous range per worker
+def split_ranges(frame_indices, workers):
+    count = len(frame_indices)
+    chunk = -(-count // workers)
+    return [frame_indices[start:start + chunk] for start in range(0, count, chunk)]
+
+# Decode the frames with the given indices and return their JPG bytes in the same order
+def decode_frames_parallel(video_path, frame_indices, resize=0, workers=DEFAULT_DECODE_WORKERS):
+    frame_indices = sorted(frame_indices)
+    if workers <= 1 or len(frame_indices) < 2:
+        return decode_buffers(video_path, frame_indices, resize)
+
+    ranges = split_ranges(frame_indices, workers)
+    # The processes are spawned on demand by submit()
+    with _executors_lock, worker_safe_main():
+        executor = get_executor(workers)
+        try:
+            futures = [executor.submit(decode_range, video_path, indices, resize) for indices in ranges]
+        except BrokenProcessPool:
+            del _executors[workers] # Start a new pool on the next call
+            raise
+
+    # Wait for every range before raising an error, so that all the shared memory blocks are released
+    results = []
+    error = None
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as ex:
+            results.append((None, []))
+            error = error or ex
+
+    buffers = []
+    complete = True
+    for indices, (name, layout) in zip(ranges, results):
+        frames = read_block(name, layout)
+        if complete:
+            buffers.extend(frames)
+        # A range that stops early (end of the stream) ends the extraction, as the sequential loop does
+        complete = complete and len(frames) == len(indices)
+
+    if error is not None:
+        if isinstance(error, BrokenProcessPool): # Start a new pool on the next call
+            with _executors_lock:
+                if _executors.get(workers) is executor:
+                    del _executors[workers]
+        raise error
+    return buffers
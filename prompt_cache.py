@@ -0,0 +1,62 @@
+# Cache-friendly layout of the GPT-4o requests and report of the prompt cache hits.
+# The prompt cache reuses the longest identical prefix of the request (from 1024 tokens, in blocks of 128 tokens),
+# so the content that is the same for every segment goes first and the content of each segment goes last
+CACHE_MIN_PREFIX_TOKENS = 1024
+
+# Static prefix: the system prompt and the user prompt, identical for all the segments of a run.
+# Variable suffix: the transcription and the frames of the segment
+def build_messages(system_prompt, user_prompt, base64frames, transcription=''):
+    content = []
+    if transcription: # Include the audio transcription
+        content.append({"type": "text", "text": f"The audio transcription is: {transcription if isinstance(transcription, str) else transcription.text}"})
+    content.extend({"type": "image_url", "image_url": {"url": f'data:image/jpg;base64,{x}', "detail": "auto"}} for x in base64frames)
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+        {"role": "user", "content": content}
+    ]
+
+# Prompt and cached tokens of the usage of a response (an SDK object or its JSON dict)
+def usage_tokens(usage):
+    if usage is None:
+        return None, None
+    if not isinstance(usage, dict):
+        usage = usage.model_dump()
+    details = usage.get("prompt_tokens_details") or {}
+    return usage.get("prompt_tokens"), details.get("cached_tokens") or 0
+
+# Cache hit ratio of the requests of one run
+class CacheReport:
+    def __init__(self):
+        self.requests = 0
+        self.requests_with_usage = 0
+        self.requests_with_hits = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def add(self, metrics):
+        self.requests += 1
+        if metrics.get("prompt_tokens") is None:
+            return
+        self.requests_with_usage += 1
+        self.prompt_tokens += metrics["prompt_tokens"]
+        self.cached_tokens += metrics.get("cached_tokens") or 0
+        if metrics.get("cached_tokens"):
+            self.requests_with_hits += 1
+
+    @property
+    def hit_ratio(self):
+        return self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0
+
+    def summary(self):
+        return {
+            "requests": self.requests,
+            "requests_with_usage": self.requests_with_usage,
+            "requests_with_cache_hits": self.requests_with_hits,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cache_hit_ratio": round(self.hit_ratio, 3),
+        }
+
+    def __str__(self):
+        return f"Prompt cache: {self.cached_tokens} of {self.prompt_tokens} prompt tokens cached ({self.hit_ratio:.1%}), {self.requests_with_hits} of {self.requests} requests with cache hits"
@@ -0,0 +1,69 @@
+# Consume a streamed chat completion, rendering the text as it arrives and measuring the latency
+import time
+from prompt_cache import usage_tokens
+
+# Default configuration
+RENDER_INTERVAL = 0.1  # Seconds between two updates of the text on the screen
+STREAM_CURSOR = "▌"
+STREAM_USAGE_MIN_API_VERSION = "2024-09-01"  # stream_options is rejected by older API versions (from 2024-09-01-preview)
+
+# Whether the API version (YYYY-MM-DD or YYYY-MM-DD-preview) accepts stream_options={"include_usage": True}
+def supports_stream_usage(api_version):
+    return api_version[:10] >= STREAM_USAGE_MIN_API_VERSION
+
+# Iterate the chunks of the stream, calling on_text(text_so_far) at most every RENDER_INTERVAL seconds.
+# Returns the full text and the metrics: time to first token, tokens per second, total time and token usage
+def consume_stream(stream, start_time, on_text=None):
+    parts = []
+    first_token_time = None
+    last_render = 0.0
+    completion_tokens = 0
+    usage = None
+
+    for chunk in stream:
+        if getattr(chunk, "usage", None) is not None:
+            usage = chunk.usage
+        # Azure sends chunks without choices (e.g. the prompt filter results)
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            continue
+        now = time.time()
+        if first_token_time is None:
+            first_token_time = now
+        parts.append(chunk.choices[0].delta.content)
+        completion_tokens += 1  # Each content chunk carries one token
+        if on_text is not None and now - last_render >= RENDER_INTERVAL:
+            on_text("".join(parts) + STREAM_CURSOR)
+            last_render = now
+
+    end_time = time.time()
+    text = "".join(parts)
+    if on_text is not None:
+        on_text(text)
+    if usage is not None:
+        completion_tokens = usage.completion_tokens
+    prompt_tokens, cached_tokens = usage_tokens(usage)
+
+    return text, stream_metrics(start_time, first_token_time or end_time, end_time, completion_tokens, prompt_tokens, cached_tokens)
+
+def stream_metrics(start_time, first_token_time, end_time, completion_tokens, prompt_tokens=None, cached_tokens=None):
+    generation_time = end_time - first_token_time
+    if generation_time <= 0: # Without streaming all the tokens arrive at once
+        generation_time = end_time - start_time
+    return {
+        "time_to_first_token": round(first_token_time - start_time, 3),
+        "total_time": round(end_time - start_time, 3),
+        "completion_tokens": completion_tokens,
+        "tokens_per_second": round(completion_tokens / generation_time, 1) if generation_time > 0 else None,
+        "prompt_tokens": prompt_tokens,
+        "cached_tokens": cached_tokens,
+    }
+
+# One line summary of the metrics of a response, for the captions of the apps. Missing values are shown as n/a
+def format_metrics(metrics):
+    tokens_per_second = metrics.get("tokens_per_second")
+    prompt_tokens = metrics.get("prompt_tokens")
+    text = f"Time to first token: {metrics['time_to_first_token']:.3f} s, "
+    text += f"{tokens_per_second} tokens/s, " if tokens_per_second is not None else "tokens/s: n/a, "
+    if prompt_tokens is None: # The response did not include the usage
+        return text + "cached prompt tokens: n/a"
+    return text + f"cached prompt tokens: {metrics.get('cached_tokens') or 0} of {prompt_tokens}"
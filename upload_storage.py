@@ -0,0 +1,180 @@
+# Write the uploaded videos to per-session storage in chunks, hashing them while they are written,
+# and let the processing start on the first segments while the rest of the file is still being written
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import cv2
+
+# Default configuration
+UPLOAD_DIR = "temp"
+UPLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+READ_MARGIN = 1.05  # Extra share of the file written before a time range is read, for the container overhead
+PROBE_STEP = 0.05  # Share of the file written between two attempts to open the partial video
+SESSION_MAX_AGE = 24 * 60 * 60  # Seconds after which the directory of an inactive session is removed
+SEGMENT_TOLERANCE = 0.5  # Seconds a segment extracted from a partial file can be shorter than its time range
+
+# Per-session directory, so concurrent sessions do not overwrite each other's uploads
+def session_upload_dir(session_state, upload_dir=UPLOAD_DIR):
+    if "upload_dir" not in session_state or not os.path.isdir(session_state["upload_dir"]):
+        os.makedirs(upload_dir, exist_ok=True)
+        cleanup_uploads(upload_dir)
+        session_state["upload_dir"] = tempfile.mkdtemp(prefix="session_", dir=upload_dir)
+    return session_state["upload_dir"]
+
+# Remove the directories of the sessions inactive for more than max_age,
+# and the stored uploads that are no longer linked from any session
+def cleanup_uploads(upload_dir=UPLOAD_DIR, max_age=SESSION_MAX_AGE):
+    now = time.time()
+    for entry in os.scandir(upload_dir):
+        if entry.is_dir() and entry.name.startswith("session_") and now - entry.stat().st_mtime > max_age:
+            shutil.rmtree(entry.path, ignore_errors=True)
+    store_dir = os.path.join(upload_dir, "store")
+    if not os.path.isdir(store_dir):
+        return
+    for entry in os.scandir(store_dir):
+        if entry.is_file() and entry.stat().st_nlink == 1:
+            try:
+                os.remove(entry.path)
+            except OSError:
+                pass
+
+# Copies a file-like object to path in a background thread, in chunks of chunk_size
+class UploadWriter(threading.Thread):
+    def __init__(self, source, path, total_size=None, chunk_size=UPLOAD_CHUNK_SIZE, store_dir=None):
+        super().__init__(daemon=True)
+        self.source = source
+        self.path = path
+        self.total_size = total_size
+        self.chunk_size = chunk_size
+        self.store_dir = store_dir
+        self.bytes_written = 0
+        self.digest = None
+        self.duplicate = False
+        self.error = None
+        self.condition = threading.Condition()
+
+    @property
+    def done(self):
+        return self.digest is not None or self.error is not None
+
+    def run(self):
+        hasher = hashlib.sha256()
+        try:
+            self.source.seek(0)
+            # A new file: writing to an existing path could write through a hard link to the store
+            with open(self.path, "xb") as f:
+                for chunk in iter(lambda: self.source.read(self.chunk_size), b""):
+                    f.write(chunk)
+                    f.flush()  # Make the chunk visible to the readers of the partial file
+                    hasher.update(chunk)
+                    with self.condition:
+                        self.bytes_written += len(chunk)
+                        self.condition.notify_all()
+            digest = hasher.hexdigest()
+            if self.store_dir is not None:
+                self.duplicate = link_to_store(self.path, digest, self.store_dir)
+        except Exception as ex:
+            with self.condition:
+                self.error = ex
+                self.condition.notify_all()
+            return
+        with self.condition:
+            self.digest = digest
+            self.condition.notify_all()
+
+    # Block until at least size bytes are written (or the file is complete)
+    def wait_for_bytes(self, size):
+        with self.condition:
+            self.condition.wait_for(lambda: self.done or self.bytes_written >= size)
+        if self.error is not None:
+            raise self.error
+
+    # Block until the file is complete and return its SHA-256
+    def wait(self):
+        self.join()
+        if self.error is not None:
+            raise self.error
+        return self.digest
+
+    # Block until cv2 can read the frame count and fps of the partial file. Files with the index
+    # at the end (non faststart MP4) can only be opened when they are complete
+    def wait_until_readable(self):
+        size = self.total_size or 0
+        probe_at = 0
+        while True:
+            self.wait_for_bytes(probe_at)
+            if self.done:
+                self.wait()
+                return
+            video = cv2.VideoCapture(self.path)
+            readable = video.isOpened() and video.get(cv2.CAP_PROP_FRAME_COUNT) > 0 and video.get(cv2.CAP_PROP_FPS) > 0
+            video.release()
+            if readable:
+                return
+            probe_at = self.bytes_written + max(self.chunk_size, int(size * PROBE_STEP))
+
+    # Block until the data of the video up to end_time is (approximately) written
+    def wait_for_time(self, end_time, duration):
+        if not self.total_size or duration <= 0:
+            self.wait()
+            return
+        self.wait_for_bytes(min(self.total_size, int(self.total_size * min(1.0, end_time / duration) * READ_MARGIN) + self.chunk_size))
+
+# Duration in seconds of a video file (0 if it cannot be read)
+def video_duration(video_path):
+    video = cv2.VideoCapture(video_path)
+    fps = video.get(cv2.CAP_PROP_FPS)
+    frames = video.get(cv2.CAP_PROP_FRAME_COUNT)
+    video.release()
+    return frames / fps if fps > 0 else 0.0
+
+# Extract the time range of a video with extract(video_path, start_time, end_time, targetname=output_file).
+# If upload is given, the file is still being written: the range is extracted when its data is (approximately) written.
+# With a variable bitrate the bytes do not grow in proportion to the time, so a segment cut short by the missing data
+# is extracted again once the file is complete. The last segment always waits for the complete file
+def extract_segment(extract, video_path, start_time, end_time, output_file, upload=None, duration=0):
+    complete = upload is None or end_time >= duration
+    if upload is not None:
+        if complete:
+            upload.wait()
+        else:
+            upload.wait_for_time(end_time, duration)
+            complete = upload.done
+    extract(video_path, start_time, end_time, targetname=output_file)
+    if not complete and video_duration(output_file) < end_time - start_time - SEGMENT_TOLERANCE:
+        print(f"WARNING: segment {output_file} was extracted before its data was written, extracting it again")
+        upload.wait()
+        extract(video_path, start_time, end_time, targetname=output_file)
+    return output_file
+
+# Content-addressed store of the uploads: identical uploads share one file (hard link).
+# Returns True if the content was already in the store
+def link_to_store(path, digest, store_dir):
+    os.makedirs(store_dir, exist_ok=True)
+    store_path = os.path.join(store_dir, f"{digest}{os.path.splitext(path)[1]}")
+    try:
+        if os.path.exists(store_path):
+            # Replace the new copy with a link to the stored one, so the content is kept only once on disk
+            temp_path = f"{path}.link"
+            os.link(store_path, temp_path)
+            os.replace(temp_path, path)
+            return True
+        os.link(path, store_path)
+    except OSError as ex: # The file system does not support hard links
+        print(f'WARNING: upload not deduplicated: {ex}')
+    return False
+
+# Start writing an uploaded file to the session directory. Each upload gets a new directory (for the file
+# and its segments), so an existing file is never overwritten, and the previous upload of the session is removed
+def start_upload(uploaded_file, session_state, upload_dir=UPLOAD_DIR):
+    session_dir = session_upload_dir(session_state, upload_dir)
+    if session_state.get("upload_file_dir"):
+        shutil.rmtree(session_state["upload_file_dir"], ignore_errors=True)
+    session_state["upload_file_dir"] = tempfile.mkdtemp(prefix="upload_", dir=session_dir)
+    path = os.path.join(session_state["upload_file_dir"], os.path.basename(uploaded_file.name))
+    writer = UploadWriter(uploaded_file, path, total_size=uploaded_file.size, store_dir=os.path.join(upload_dir, "store"))
+    writer.start()
+    return writer
@@ -7,7 +7,14 @@ import json
 from dotenv import load_dotenv
 from moviepy.video.io.ffmpeg_tools import ffmpeg_extract_subclip
 from moviepy.editor import VideoFileClip
-from openai import AzureOpenAI
+from aoai_pool import create_aoai_pool, create_whisper_pool, estimate_chat_tokens
+from frame_mosaic import pack_frames, mosaic_prompt
+from motion_sampling import motion_frame_indices, DEFAULT_FRAME_BUDGET
+from parallel_decoding import decode_frames_parallel, DEFAULT_DECODE_WORKERS
+from frame_store import FrameStore
+from response_stream import consume_stream, stream_metrics, format_metrics, supports_stream_usage
+from prompt_cache import build_messages, usage_tokens, CacheReport
+from upload_storage import start_upload, extract_segment
 import base64
 import yt_dlp
 from yt_dlp.utils import download_range_func
@@ -19,6 +26,7 @@ USER_PROMPT = "These are the frames from the video."
 DEFAULT_TEMPERATURE = 0.5
 RESIZE_OF_FRAMES = 2
 SECONDS_PER_FRAME = 30
+SAMPLING_STRATEGIES = ["Uniform", "Motion-adaptive"]
 
 # Load configuration
 load_dotenv(override=True)
@@ -30,71 +38,69 @@ aoai_apiversion = os.environ["AZURE_OPENAI_API_VERSION"]
 aoai_model_name = os.environ["AZURE_OPENAI_DEPLOYMENT_NAME"]
 system_prompt = os.environ.get("SYSTEM_PROMPT", "You are an expert on Video Analysis. You will be shown a series of images from a video. Describe what is happening in the video, including the objects, actions, and any other relevant details. Be as specific and detailed as possible.")
 print(f'aoai_endpoint: {aoai_endpoint}, aoai_model_name: {aoai_model_name}')
-# Create AOAI client for answer generation
-aoai_client = AzureOpenAI(
-    azure_deployment=aoai_model_name,
-    api_version=aoai_apiversion, #'2024-02-15-preview',
-    azure_endpoint=aoai_endpoint,
-    api_key=aoai_apikey
-)
+# Create the pool of AOAI deployments for answer generation (AZURE_OPENAI_DEPLOYMENTS can list several deployments)
+aoai_pool = create_aoai_pool()
+# The usage of the streamed responses (prompt and cached tokens) needs an API version that accepts stream_options
+stream_usage = all(supports_stream_usage(deployment.api_version) for deployment in aoai_pool.deployments)
+if not stream_usage:
+    print(f'WARNING: AZURE_OPENAI_API_VERSION {aoai_apiversion} does not accept stream_options (2024-09-01-preview or later): the streamed analyses will not report the prompt and cached tokens')
 
 # Configuration of Whisper
 whisper_endpoint = os.environ["WHISPER_ENDPOINT"]
 whisper_apikey = os.environ["WHISPER_API_KEY"]
 whisper_apiversion = os.environ["WHISPER_API_VERSION"]
 whisper_model_name = os.environ["WHISPER_DEPLOYMENT_NAME"]
-# Create AOAI client for whisper
-whisper_client = AzureOpenAI(
-    api_version=whisper_apiversion,
-    azure_endpoint=whisper_endpoint,
-    api_key=whisper_apikey
-)
+# Create the pool of AOAI deployments for whisper (WHISPER_DEPLOYMENTS can list several deployments)
+whisper_pool = create_whisper_pool()
 
 # Function to encode a local video into frames
-def process_video(video_path, seconds_per_frame=SECONDS_PER_FRAME, resize=RESIZE_OF_FRAMES, output_dir='', temperature = DEFAULT_TEMPERATURE):
+# Returns the base64 frames and the timestamp (in seconds) of each frame
+def process_video(video_path, seconds_per_frame=SECONDS_PER_FRAME, resize=RESIZE_OF_FRAMES, output_dir='', temperature = DEFAULT_TEMPERATURE, sampling="Uniform", frame_budget=DEFAULT_FRAME_BUDGET, decode_workers=DEFAULT_DECODE_WORKERS, start_offset=0):
     base64Frames = []
+    timestamps = []
 
     # Prepare the video analysis
     video = cv2.VideoCapture(video_path)
     total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
     fps = video.get(cv2.CAP_PROP_FPS)
-    frames_to_skip = int(fps * seconds_per_frame)
-    curr_frame=0
-
-    # Prepare to write the frames to disk
-    if output_dir != '': # if we want to write the frame to disk
-        output_dir = 'frames'
-        os.makedirs(output_dir, exist_ok=True)
-        frame_count = 1
-
-    # Loop through the video and extract frames at specified sampling rate
-    while curr_frame < total_frames - 1:
-        video.set(cv2.CAP_PROP_POS_FRAMES, curr_frame)
-        success, frame = video.read()
-        if not success:
-            break
-
-        # Resize the frame to save tokens and get faster answer from the model. If resize==0 don't resize
-        if resize != 0:
-            height, width, _ = frame.shape
-            frame = cv2.resize(frame, (width // resize, height // resize))
-
-        _, buffer = cv2.imencode(".jpg", frame)
-
-        # Save frame as JPG file
-        if output_dir != '': # if we want to write the frame to disk
-            frame_filename = os.path.join(output_dir, f"{os.path.splitext(os.path.basename(video_path))[0]}_frame_{frame_count}.jpg")
-            print(f'Saving frame {frame_filename}')
-            with open(frame_filename, "wb") as f:
-                f.write(buffer)            
-            frame_count += 1
+    video.release()
 
+    # Choose the frames to extract: one every seconds_per_frame, or the frame budget spent on the moments with more motion
+    if sampling == "Motion-adaptive":
+        frame_indices = motion_frame_indices(video_path, frame_budget=frame_budget)
+    else:
+        frames_to_skip = max(1, int(fps * seconds_per_frame))
+        frame_indices = range(0, total_frames - 1, frames_to_skip)
+
+    frame_indices = list(frame_indices)
+
+    # Reuse the frames already in the frame store of this video (if we want to write the frames to disk)
+    if output_dir != '':
+        store = FrameStore.for_video(output_dir, video_path, resize)
+        stored = store.read(frame_indices)
+    else:
+        store = None
+        stored = {}
+
+    # Decode the missing frames, split in time ranges across decode_workers processes
+    missing = [curr_frame for curr_frame in frame_indices if curr_frame not in stored]
+    buffers = dict(zip(missing, decode_frames_parallel(video_path, missing, resize=resize, workers=decode_workers)))
+
+    # Append the new frames to the pack file of the store instead of writing one JPG file per frame
+    if store is not None:
+        store.append([(curr_frame, curr_frame / fps, buffers[curr_frame]) for curr_frame in missing if curr_frame in buffers])
+        print(f'Reused {len(stored)} frames and saved {len(buffers)} frames in {store.pack_path}')
+    buffers.update(stored)
+
+    for curr_frame in frame_indices:
+        if curr_frame not in buffers: # The end of the video was reached
+            break
+        buffer = buffers[curr_frame]
         base64Frames.append(base64.b64encode(buffer).decode("utf-8"))
-        curr_frame += frames_to_skip
-    video.release()
+        timestamps.append(start_offset + curr_frame / fps) # Time in the source video, not in the segment file
     print(f"Extracted {len(base64Frames)} frames")
     
-    return base64Frames
+    return base64Frames, timestamps
 
 # Function to transcript the audio from the local video with Whisper
 def process_audio(video_path):
@@ -110,10 +116,14 @@ def process_audio(video_path):
         print(f"Extracted audio to {audio_path}")
 
         # Transcribe the audio
-        transcription = whisper_client.audio.transcriptions.create(
-            model=whisper_model_name,
-            file=open(audio_path, "rb"),
-        )
+        def transcribe(client, model):
+            with open(audio_path, "rb") as audio_file:
+                return client.audio.transcriptions.create(
+                    model=model,
+                    file=audio_file,
+                )
+        # The size of the audio stands for the tokens, so the Whisper deployments are balanced by outstanding audio
+        transcription = whisper_pool.call(transcribe, tokens=os.path.getsize(audio_path))
         transcription_text = transcription.text
         print("Transcript: ", transcription_text + "\n\n")
     except Exception as ex:
@@ -123,50 +133,63 @@ def process_audio(video_path):
     return transcription_text
 
 # Function to analyze the video with GPT-4o
-def analyze_video(base64frames, system_prompt, user_prompt, transcription, temperature):
+# Returns the analysis and its metrics. With stream=True the text is rendered in the placeholder as the tokens arrive
+def analyze_video(base64frames, system_prompt, user_prompt, transcription, temperature, stream=False, placeholder=None):
     print(f'SYSTEM PROMPT: [{system_prompt}]')
     print(f'USER PROMPT:   [{user_prompt}]')
 
     try:
-        if transcription: # Include the audio transcription
-            response = aoai_client.chat.completions.create(
-                model=aoai_model_name,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt},
-                    {"role": "user", "content": [
-                        *map(lambda x: {"type": "image_url", "image_url": {"url": f'data:image/jpg;base64,{x}', "detail": "auto"}}, base64frames),
-                        {"type": "text", "text": f"The audio transcription is: {transcription if isinstance(transcription, str) else transcription.text}"}
-                    ]}
-                ],
-                temperature=temperature,
-                max_tokens=4096
+        # Static prompts first and the frames and transcription of the segment last, so the prefix can be cached
+        messages = build_messages(system_prompt, user_prompt, base64frames, transcription)
+
+        # Send the request to the deployment with the least outstanding tokens (failing over on 429/5xx)
+        start_time = time.time()
+        if stream: # Render the tokens as they arrive
+            response, metrics = aoai_pool.call(
+                lambda client, model: consume_stream(
+                    client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        temperature=temperature,
+                        max_tokens=4096,
+                        stream=True,
+                        **({"stream_options": {"include_usage": True}} if stream_usage else {})
+                    ),
+                    start_time,
+                    on_text=placeholder.markdown if placeholder is not None else None
+                ),
+                tokens=estimate_chat_tokens(messages, max_tokens=4096)
             )
-        else: # Without the audio transcription
-            response = aoai_client.chat.completions.create(
-                model=aoai_model_name,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt},
-                    {"role": "user", "content": [
-                        *map(lambda x: {"type": "image_url", "image_url": {"url": f'data:image/jpg;base64,{x}', "detail": "auto"}}, base64frames),
-                    ]}
-                ],
-                temperature=0.5,
-                max_tokens=4096
+        else:
+            response = aoai_pool.call(
+                lambda client, model: client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=4096
+                ),
+                tokens=estimate_chat_tokens(messages, max_tokens=4096)
             )
+            end_time = time.time()
 
-        json_response = json.loads(response.model_dump_json())
-        response = json_response['choices'][0]['message']['content']
+            json_response = json.loads(response.model_dump_json())
+            response = json_response['choices'][0]['message']['content']
+            metrics = stream_metrics(start_time, end_time, end_time, json_response['usage']['completion_tokens'], *usage_tokens(json_response['usage']))
+        print(f"Analysis metrics: {metrics}")
 
     except Exception as ex:
         print(f'ERROR: {ex}')
         response = f'ERROR: {ex}'
+        metrics = {}
 
-    return response
+    return response, metrics
 
 # Split the video in segments of N seconds (by default 3 minutes). If segment_length is 0 the full video is processed
-def split_video(video_path, output_dir, segment_length=180):
+# Yields the path of each segment and its start time in the video
+# If upload is given, the file is still being written: each segment is extracted as soon as its data is written
+def split_video(video_path, output_dir, segment_length=180, upload=None):
+    if upload is not None:
+        upload.wait_until_readable()
     cap = cv2.VideoCapture(video_path)
     fps = cap.get(cv2.CAP_PROP_FPS)
     total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
@@ -178,11 +201,11 @@ def split_video(video_path, output_dir, segment_length=180):
     for start_time in range(0, int(duration), segment_length):
         end_time = min(start_time + segment_length, duration)
         output_file = os.path.join(output_dir, f'{os.path.splitext(os.path.basename(video_path))[0]}_segment_{start_time}-{end_time}_secs.mp4')
-        ffmpeg_extract_subclip(video_path, start_time, end_time, targetname=output_file)
-        yield output_file
+        extract_segment(ffmpeg_extract_subclip, video_path, start_time, end_time, output_file, upload=upload, duration=duration)
+        yield output_file, start_time
 
 # Process the video
-def execute_video_processing(st, segment_path, system_prompt, user_prompt, temperature):
+def execute_video_processing(st, segment_path, system_prompt, user_prompt, temperature, start_offset=0):
     # Show the video on the screen
     st.write(f"Video: {segment_path}:")
     st.video(segment_path)
@@ -195,7 +218,11 @@ def execute_video_processing(st, segment_path, system_prompt, user_prompt, tempe
                 output_dir = 'frames'
             else:
                 output_dir = ''
-            base64frames = process_video(segment_path, seconds_per_frame=seconds_per_frame, resize=resize, output_dir=output_dir, temperature=temperature)
+            base64frames, timestamps = process_video(segment_path, seconds_per_frame=seconds_per_frame, resize=resize, output_dir=output_dir, temperature=temperature, sampling=sampling, frame_budget=frame_budget, decode_workers=decode_workers, start_offset=start_offset)
+            # Pack consecutive frames into mosaics to save the per-image token overhead
+            if frames_per_mosaic > 1:
+                base64frames = pack_frames(base64frames, timestamps, frames_per_mosaic=frames_per_mosaic)
+                user_prompt = f"{user_prompt} {mosaic_prompt(frames_per_mosaic)}"
             end_time = time.time()
             print(f'\t>>>> Frames extraction took {(end_time - start_time):.3f} seconds <<<<')
             ### st.write(f'Extracted {len(base64frames)} frames in {(end_time - start_time):.3f} seconds')
@@ -218,9 +245,16 @@ def execute_video_processing(st, segment_path, system_prompt, user_prompt, tempe
         # Analyze the video frames and the audio transcription with GPT-4o
         with st.spinner(msg):
             start_time = time.time()
-            analysis = analyze_video(base64frames, system_prompt, user_prompt, transcription, temperature)
+            # With streaming, the tokens are shown in a placeholder while they arrive
+            placeholder = st.empty() if stream_analysis else None
+            analysis, metrics = analyze_video(base64frames, system_prompt, user_prompt, transcription, temperature, stream=stream_analysis, placeholder=placeholder)
             end_time = time.time()
+            if placeholder is not None:
+                placeholder.empty() # The full analysis is presented after the segment is processed
         print(f'\t>>>> Analysis with {aoai_model_name} took {(end_time - start_time):.3f} seconds <<<<')
+        if metrics:
+            st.caption(format_metrics(metrics))
+            cache_report.add(metrics)
 
     ### st.write(f"**Analysis of segment {segment_path}** ({(end_time - start_time):.3f} seconds)")
     end_time = time.time()
@@ -251,10 +285,19 @@ with st.sidebar:
     if audio_transcription:
         show_transcription = st.checkbox('Show audio transcription', True, help="Present the audio transcription or not")
     seconds_split = st.number_input('Number of seconds to split the video', initial_split, help="The video will be processed in smaller segments based on the number of seconds specified in this field. (0 to not split)")
-    seconds_per_frame = float(st.text_input('Number of seconds per frame', SECONDS_PER_FRAME, help="The frames will be extracted every number of seconds specified in the field. It can be a decimal number, like 0.5, to extract a frame every half of second."))
+    sampling = st.selectbox("Frame sampling", SAMPLING_STRATEGIES, index=0, help="Uniform extracts a frame every number of seconds. Motion-adaptive spends a fixed number of frames per segment on the moments with more changes")
+    if sampling == "Motion-adaptive":
+        frame_budget = st.number_input('Number of frames per segment', min_value=1, value=DEFAULT_FRAME_BUDGET, help="The frames will be extracted where the video changes the most, using a fast low resolution pass to score the motion.")
+        seconds_per_frame = SECONDS_PER_FRAME
+    else:
+        frame_budget = DEFAULT_FRAME_BUDGET
+        seconds_per_frame = float(st.text_input('Number of seconds per frame', SECONDS_PER_FRAME, help="The frames will be extracted every number of seconds specified in the field. It can be a decimal number, like 0.5, to extract a frame every half of second."))
     resize = st.number_input("Frames resizing ratio", 0, help="The size of the images will be reduced in proportion to this number while maintaining the height/width ratio. This reduction is useful for improving latency and reducing token consumption (0 to not resize)")
-    save_frames = st.checkbox('Save the frames to the folder "frames"', False)
+    decode_workers = st.number_input("Decoding processes", min_value=1, value=DEFAULT_DECODE_WORKERS, help="The frames are decoded in parallel by this number of processes, each one decoding a time range of the video")
+    frames_per_mosaic = st.number_input("Frames per mosaic", min_value=0, value=0, help="Consecutive frames are packed into a grid image with the timestamp of each frame, so more frames fit in the same token budget (0 or 1 to send each frame as its own image)")
+    save_frames = st.checkbox('Save the frames to the folder "frames"', False, help="The frames are saved in one pack file per video with an index, and reused when the same video is analyzed again")
     temperature = float(st.number_input('Temperature for the model', DEFAULT_TEMPERATURE))
+    stream_analysis = st.checkbox('Stream the analysis', True, help="Show the tokens of the analysis as they are generated and measure the time to first token and the tokens per second")
     system_prompt = st.text_area('System Prompt', system_prompt)
     user_prompt = st.text_area('User Prompt', USER_PROMPT)
 
@@ -274,11 +317,13 @@ else:
 
 # Analyze the video when the button is pressed
 if st.button("Analyze video", use_container_width=True, type='primary'):
+    # Report of the prompt cache hits of the segments of this run
+    cache_report = CacheReport()
 
     # Show parameters:
     print(f"PARAMETERS:")
     print(f"file_or_url: {file_or_url}, audio_transcription: {audio_transcription}, seconds to split: {seconds_split}")
-    print(f"seconds_per_frame: {seconds_per_frame}, resize ratio: {resize}, save_frames: {save_frames}, temperature: {temperature}")
+    print(f"stream_analysis: {stream_analysis}, sampling: {sampling}, frame_budget: {frame_budget}, seconds_per_frame: {seconds_per_frame}, resize ratio: {resize}, decode_workers: {decode_workers}, frames_per_mosaic: {frames_per_mosaic}, save_frames: {save_frames}, temperature: {temperature}")
 
     if file_or_url == 'URL': # Process Youtube video
         st.write(f'Analyzing video from URL {url}...')
@@ -334,7 +379,7 @@ if st.button("Analyze video", use_container_width=True, type='primary'):
             print(f"Segment downloaded: {segment_path}")
 
             # Process the video segment
-            analysis = execute_video_processing(st, segment_path, system_prompt, user_prompt, temperature)
+            analysis = execute_video_processing(st, segment_path, system_prompt, user_prompt, temperature, start_offset=start)
             st.markdown(f"**Description**: {analysis}", unsafe_allow_html=True)
             #st.write(f"{analysis}")
 
@@ -349,24 +394,32 @@ if st.button("Analyze video", use_container_width=True, type='primary'):
 
     else: # Process the video file
         if video_file is not None:
-            os.makedirs("temp", exist_ok=True)
-            video_path = os.path.join("temp", video_file.name)
+            # Write the upload in chunks to the directory of this session, in the background
+            upload = start_upload(video_file, st.session_state)
+            video_path = upload.path
         try:
-            with open(video_path, "wb") as f:
-                f.write(video_file.getbuffer())
-            print(f"Uploaded video file: {video_path}")
+            print(f"Uploading video file: {video_path}")
 
-            # Splitting video in segment of N seconds (if seconds is 0 it will not split the video)
-            for segment_path in split_video(video_path, output_dir, seconds_split):
+            # Splitting video in segment of N seconds (if seconds is 0 it will not split the video).
+            # The segments are written next to the upload, so concurrent sessions do not share them
+            for segment_path, segment_start in split_video(video_path, os.path.dirname(video_path), seconds_split, upload=upload):
                 print(f"Processing segment: {segment_path}")
                 # Process the video segment
-                analysis = execute_video_processing(st, segment_path, system_prompt, user_prompt, temperature)
+                analysis = execute_video_processing(st, segment_path, system_prompt, user_prompt, temperature, start_offset=segment_start)
                 st.write(f"{analysis}")
 
                 # Delete the video segment
                 os.remove(segment_path)
                 print(f"Deleted segment: {segment_path}")
 
+            digest = upload.wait()
+            print(f"Uploaded video file: {video_path} (sha256: {digest}{', already uploaded' if upload.duplicate else ''})")
+
         except Exception as ex:
             print(f'ERROR: {ex}')
-            st.write(f'ERROR: {ex}')
\ No newline at end of file
+            st.write(f'ERROR: {ex}')
+
+    # Show the prompt cache hit ratio of the run
+    print(f"{cache_report}: {cache_report.summary()}")
+    if cache_report.requests > 0:
+        st.write(str(cache_report))
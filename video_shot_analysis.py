@@ -7,7 +7,14 @@ import json
 from dotenv import load_dotenv
 from moviepy.video.io.ffmpeg_tools import ffmpeg_extract_subclip
 from moviepy.editor import VideoFileClip
-from openai import AzureOpenAI
+from aoai_pool import create_aoai_pool, create_whisper_pool, estimate_chat_tokens
+from frame_mosaic import pack_frames, mosaic_prompt
+from motion_sampling import motion_frame_indices, DEFAULT_FRAME_BUDGET
+from parallel_decoding import decode_frames_parallel, DEFAULT_DECODE_WORKERS
+from frame_store import FrameStore
+from response_stream import consume_stream, stream_metrics, format_metrics, supports_stream_usage
+from prompt_cache import build_messages, usage_tokens, CacheReport
+from upload_storage import start_upload, extract_segment
 import base64
 import yt_dlp
 from yt_dlp.utils import download_range_func
@@ -19,6 +26,7 @@ SYSTEM_PROMPT = "You are a helpful assistant that describes in detail a video. R
 USER_PROMPT = "These are the frames from the video."
 DEFAULT_TEMPERATURE = 0.5
 RESIZE_OF_FRAMES = 4  # Changed default resize ratio to 4
+SAMPLING_STRATEGIES = ["Uniform", "Motion-adaptive"]
 
 # Load configuration
 load_dotenv(override=True)
@@ -30,72 +38,70 @@ aoai_apiversion = os.environ["AZURE_OPENAI_API_VERSION"]
 aoai_model_name = os.environ["AZURE_OPENAI_DEPLOYMENT_NAME"]
 system_prompt = os.environ.get("SYSTEM_PROMPT", "You are an expert on Video Analysis. You will be shown a series of images from a video. Describe what is happening in the video, including the objects, actions, and any other relevant details. Be as specific and detailed as possible.")
 # print(f'aoai_endpoint: {aoai_endpoint}, aoai_model_name: {aoai_model_name}')
-# Create AOAI client for answer generation
-aoai_client = AzureOpenAI(
-    azure_deployment=aoai_model_name,
-    api_version=aoai_apiversion,
-    azure_endpoint=aoai_endpoint,
-    api_key=aoai_apikey
-)
+# Create the pool of AOAI deployments for answer generation (AZURE_OPENAI_DEPLOYMENTS can list several deployments)
+aoai_pool = create_aoai_pool()
+# The usage of the streamed responses (prompt and cached tokens) needs an API version that accepts stream_options
+stream_usage = all(supports_stream_usage(deployment.api_version) for deployment in aoai_pool.deployments)
+if not stream_usage:
+    print(f'WARNING: AZURE_OPENAI_API_VERSION {aoai_apiversion} does not accept stream_options (2024-09-01-preview or later): the streamed analyses will not report the prompt and cached tokens')
 
 # Configuration of Whisper
 whisper_endpoint = os.environ["WHISPER_ENDPOINT"]
 whisper_apikey = os.environ["WHISPER_API_KEY"]
 whisper_apiversion = os.environ["WHISPER_API_VERSION"]
 whisper_model_name = os.environ["WHISPER_DEPLOYMENT_NAME"]
-# Create AOAI client for whisper
-whisper_client = AzureOpenAI(
-    api_version=whisper_apiversion,
-    azure_endpoint=whisper_endpoint,
-    api_key=whisper_apikey
-)
+# Create the pool of AOAI deployments for whisper (WHISPER_DEPLOYMENTS can list several deployments)
+whisper_pool = create_whisper_pool()
 
 # Function to encode a local video into frames
-def process_video(video_path, frames_per_second=DEFAULT_FRAMES_PER_SECOND, resize=RESIZE_OF_FRAMES, output_dir='', temperature=DEFAULT_TEMPERATURE):
-    print(f"Starting video processing for {video_path} with frames_per_second={frames_per_second}, resize={resize}")
+# Returns the base64 frames and the timestamp (in seconds) of each frame
+def process_video(video_path, frames_per_second=DEFAULT_FRAMES_PER_SECOND, resize=RESIZE_OF_FRAMES, output_dir='', temperature=DEFAULT_TEMPERATURE, sampling="Uniform", frame_budget=DEFAULT_FRAME_BUDGET, decode_workers=DEFAULT_DECODE_WORKERS, start_offset=0):
+    print(f"Starting video processing for {video_path} with sampling={sampling}, frames_per_second={frames_per_second}, frame_budget={frame_budget}, resize={resize}")
     base64Frames = []
+    timestamps = []
 
     # Prepare the video analysis
     video = cv2.VideoCapture(video_path)
     total_frames = int(video.get(cv2.CAP_PROP_FRAME_COUNT))
     fps = video.get(cv2.CAP_PROP_FPS)
-    frames_to_skip = int(fps / frames_per_second)
-    curr_frame = 0
-
-    # Prepare to write the frames to disk
-    if output_dir != '':
-        os.makedirs(output_dir, exist_ok=True)
-        frame_count = 1
-
-    # Loop through the video and extract frames at the specified sampling rate
-    while curr_frame < total_frames - 1:
-        video.set(cv2.CAP_PROP_POS_FRAMES, curr_frame)
-        success, frame = video.read()
-        if not success:
-            break
-
-        print(f"Processing frame {curr_frame}/{total_frames}")
-
-        # Resize the frame if required
-        if resize != 0:
-            height, width, _ = frame.shape
-            frame = cv2.resize(frame, (width // resize, height // resize))
+    video.release()
 
-        _, buffer = cv2.imencode(".jpg", frame)
+    # Choose the frames to extract: at the specified rate, or the frame budget spent on the moments with more motion
+    if sampling == "Motion-adaptive":
+        frame_indices = motion_frame_indices(video_path, frame_budget=frame_budget)
+    else:
+        frames_to_skip = max(1, int(fps / frames_per_second))
+        frame_indices = range(0, total_frames - 1, frames_to_skip)
 
-        # Save frame as JPG file if output_dir is specified
-        if output_dir != '':
-            frame_filename = os.path.join(output_dir, f"{os.path.splitext(os.path.basename(video_path))[0]}_frame_{frame_count}.jpg")
-            with open(frame_filename, "wb") as f:
-                f.write(buffer)
-            frame_count += 1
+    frame_indices = list(frame_indices)
 
+    # Reuse the frames already in the frame store of this video (if we want to write the frames to disk)
+    if output_dir != '':
+        store = FrameStore.for_video(output_dir, video_path, resize)
+        stored = store.read(frame_indices)
+    else:
+        store = None
+        stored = {}
+
+    # Decode the missing frames, split in time ranges across decode_workers processes
+    missing = [curr_frame for curr_frame in frame_indices if curr_frame not in stored]
+    buffers = dict(zip(missing, decode_frames_parallel(video_path, missing, resize=resize, workers=decode_workers)))
+
+    # Append the new frames to the pack file of the store instead of writing one JPG file per frame
+    if store is not None:
+        store.append([(curr_frame, curr_frame / fps, buffers[curr_frame]) for curr_frame in missing if curr_frame in buffers])
+        print(f'Reused {len(stored)} frames and saved {len(buffers)} frames in {store.pack_path}')
+    buffers.update(stored)
+
+    for curr_frame in frame_indices:
+        if curr_frame not in buffers: # The end of the video was reached
+            break
+        buffer = buffers[curr_frame]
         base64Frames.append(base64.b64encode(buffer).decode("utf-8"))
-        curr_frame += frames_to_skip
-    video.release()
+        timestamps.append(start_offset + curr_frame / fps) # Time in the source video, not in the shot file
     print(f"Extracted {len(base64Frames)} frames from {video_path}")
 
-    return base64Frames
+    return base64Frames, timestamps
 
 # Function to transcript the audio from the local video with Whisper
 def process_audio(video_path):
@@ -112,10 +118,14 @@ def process_audio(video_path):
 
         # Transcribe the audio
         print(f"Transcribing audio from {audio_path}")
-        transcription = whisper_client.audio.transcriptions.create(
-            model=whisper_model_name,
-            file=open(audio_path, "rb"),
-        )
+        def transcribe(client, model):
+            with open(audio_path, "rb") as audio_file:
+                return client.audio.transcriptions.create(
+                    model=model,
+                    file=audio_file,
+                )
+        # The size of the audio stands for the tokens, so the Whisper deployments are balanced by outstanding audio
+        transcription = whisper_pool.call(transcribe, tokens=os.path.getsize(audio_path))
         transcription_text = transcription.text
         print("Transcript: ", transcription_text + "\n\n")
     except Exception as ex:
@@ -125,58 +135,71 @@ def process_audio(video_path):
     return transcription_text
 
 # Function to analyze the video with GPT-4o
-def analyze_video(base64frames, system_prompt, user_prompt, transcription, temperature):
+# Returns the analysis and its metrics. With stream=True the text is rendered in the placeholder as the tokens arrive
+def analyze_video(base64frames, system_prompt, user_prompt, transcription, temperature, stream=False, placeholder=None):
     print(f"Starting video analysis with system_prompt={system_prompt} and user_prompt={user_prompt}")
     print(f"Number of frames to analyze: {len(base64frames)}")
     if transcription:
         print(f"Including audio transcription in the analysis")
 
     try:
-        if transcription: # Include the audio transcription
-            response = aoai_client.chat.completions.create(
-                model=aoai_model_name,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt},
-                    {"role": "user", "content": [
-                        *map(lambda x: {"type": "image_url", "image_url": {"url": f'data:image/jpg;base64,{x}', "detail": "auto"}}, base64frames),
-                        {"type": "text", "text": f"The audio transcription is: {transcription if isinstance(transcription, str) else transcription.text}"}
-                    ]}
-                ],
-                temperature=temperature,
-                max_tokens=4096
+        # Static prompts first and the frames and transcription of the segment last, so the prefix can be cached
+        messages = build_messages(system_prompt, user_prompt, base64frames, transcription)
+
+        # Send the request to the deployment with the least outstanding tokens (failing over on 429/5xx)
+        start_time = time.time()
+        if stream: # Render the tokens as they arrive
+            response, metrics = aoai_pool.call(
+                lambda client, model: consume_stream(
+                    client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        temperature=temperature,
+                        max_tokens=4096,
+                        stream=True,
+                        **({"stream_options": {"include_usage": True}} if stream_usage else {})
+                    ),
+                    start_time,
+                    on_text=placeholder.markdown if placeholder is not None else None
+                ),
+                tokens=estimate_chat_tokens(messages, max_tokens=4096)
             )
-        else: # Without the audio transcription
-            response = aoai_client.chat.completions.create(
-                model=aoai_model_name,
-                messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": user_prompt},
-                    {"role": "user", "content": [
-                        *map(lambda x: {"type": "image_url", "image_url": {"url": f'data:image/jpg;base64,{x}', "detail": "auto"}}, base64frames),
-                    ]}
-                ],
-                temperature=0.5,
-                max_tokens=4096
+        else:
+            response = aoai_pool.call(
+                lambda client, model: client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=4096
+                ),
+                tokens=estimate_chat_tokens(messages, max_tokens=4096)
             )
+            end_time = time.time()
 
-        json_response = json.loads(response.model_dump_json())
-        response = json_response['choices'][0]['message']['content']
+            json_response = json.loads(response.model_dump_json())
+            response = json_response['choices'][0]['message']['content']
+            metrics = stream_metrics(start_time, end_time, end_time, json_response['usage']['completion_tokens'], *usage_tokens(json_response['usage']))
         print("Analysis completed successfully")
+        print(f"Analysis metrics: {metrics}")
 
     except Exception as ex:
         print(f'ERROR: {ex}')
         response = f'ERROR: {ex}'
+        metrics = {}
 
-    return response
+    return response, metrics
 
-# Split the video into shots of N seconds
-def split_video(video_path, output_dir, shot_interval=DEFAULT_SHOT_INTERVAL, max_duration=None):
+# Split the video into shots of N seconds. Yields the path of each shot and its start time in the video
+# If upload is given, the file is still being written: each shot is extracted as soon as its data is written
+def split_video(video_path, output_dir, shot_interval=DEFAULT_SHOT_INTERVAL, max_duration=None, upload=None):
     print(f"Starting video splitting for {video_path} with shot_interval={shot_interval}, max_duration={max_duration}")
+    if upload is not None:
+        upload.wait_until_readable()
     cap = cv2.VideoCapture(video_path)
     fps = cap.get(cv2.CAP_PROP_FPS)
     total_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
     duration = total_frames / fps
+    video_duration = duration
 
     if max_duration is not None and max_duration > 0:
         duration = min(duration, max_duration)
@@ -185,11 +208,11 @@ def split_video(video_path, output_dir, shot_interval=DEFAULT_SHOT_INTERVAL, max
         end_time = min(start_time + shot_interval, duration)
         output_file = os.path.join(output_dir, f'{os.path.splitext(os.path.basename(video_path))[0]}_shot_{start_time}-{end_time}_secs.mp4')
         print(f"Extracting shot from {start_time} to {end_time} into {output_file}")
-        ffmpeg_extract_subclip(video_path, start_time, end_time, targetname=output_file)
-        yield output_file
+        extract_segment(ffmpeg_extract_subclip, video_path, start_time, end_time, output_file, upload=upload, duration=video_duration)
+        yield output_file, start_time
 
 # Process the video
-def execute_video_processing(st, shot_path, system_prompt, user_prompt, temperature, frames_per_second, analysis_dir):
+def execute_video_processing(st, shot_path, system_prompt, user_prompt, temperature, frames_per_second, analysis_dir, start_offset=0):
     print(f"Starting video processing for shot {shot_path}")
     # Show the video on the screen
     st.write(f"Video: {shot_path}:")
@@ -204,7 +227,11 @@ def execute_video_processing(st, shot_path, system_prompt, user_prompt, temperat
             else:
                 output_dir = ''
             print(f"Extracting frames from {shot_path}")
-            base64frames = process_video(shot_path, frames_per_second=frames_per_second, resize=resize, output_dir=output_dir, temperature=temperature)
+            base64frames, timestamps = process_video(shot_path, frames_per_second=frames_per_second, resize=resize, output_dir=output_dir, temperature=temperature, sampling=sampling, frame_budget=frame_budget, decode_workers=decode_workers, start_offset=start_offset)
+            # Pack consecutive frames into mosaics to save the per-image token overhead
+            if frames_per_mosaic > 1:
+                base64frames = pack_frames(base64frames, timestamps, frames_per_mosaic=frames_per_mosaic)
+                user_prompt = f"{user_prompt} {mosaic_prompt(frames_per_mosaic)}"
             end_time = time.time()
             print(f'\t>>>> Frames extraction took {(end_time - start_time):.3f} seconds <<<<')
 
@@ -228,9 +255,16 @@ def execute_video_processing(st, shot_path, system_prompt, user_prompt, temperat
         with st.spinner(msg):
             print(f"Analyzing frames with {aoai_model_name}")
             start_time = time.time()
-            analysis = analyze_video(base64frames, system_prompt, user_prompt, transcription, temperature)
+            # With streaming, the tokens are shown in a placeholder while they arrive
+            placeholder = st.empty() if stream_analysis else None
+            analysis, metrics = analyze_video(base64frames, system_prompt, user_prompt, transcription, temperature, stream=stream_analysis, placeholder=placeholder)
             end_time = time.time()
+            if placeholder is not None:
+                placeholder.empty() # The full analysis is presented after the shot is processed
         print(f'\t>>>> Analysis with {aoai_model_name} took {(end_time - start_time):.3f} seconds <<<<')
+        if metrics:
+            st.caption(format_metrics(metrics))
+            cache_report.add(metrics)
 
     st.success("Analysis completed.")
     print(f"Analysis completed for shot {shot_path}")
@@ -241,7 +275,7 @@ def execute_video_processing(st, shot_path, system_prompt, user_prompt, temperat
     # Save the analysis to a JSON file in the analysis directory
     analysis_filename = os.path.join(analysis_dir, os.path.splitext(os.path.basename(shot_path))[0] + "_analysis.json")
     with open(analysis_filename, 'w') as json_file:
-        json.dump({"analysis": analysis}, json_file, indent=4)
+        json.dump({"analysis": analysis, "metrics": metrics}, json_file, indent=4)
     print(f"Analysis saved as: {analysis_filename}")
 
     return analysis
@@ -268,10 +302,19 @@ with st.sidebar:
     if audio_transcription:
         show_transcription = st.checkbox('Show audio transcription', True, help="Present the audio transcription or not")
     shot_interval = st.number_input(label='Shot interval in seconds', min_value=0, value=DEFAULT_SHOT_INTERVAL, help="The video will be processed in shots based on the number of seconds specified in this field.")
-    frames_per_second = st.number_input('Frames per second', DEFAULT_FRAMES_PER_SECOND, help="The number of frames to extract per second.")
+    sampling = st.selectbox("Frame sampling", SAMPLING_STRATEGIES, index=0, help="Uniform extracts frames at a fixed rate. Motion-adaptive spends a fixed number of frames per shot on the moments with more changes")
+    if sampling == "Motion-adaptive":
+        frame_budget = st.number_input('Number of frames per shot', min_value=1, value=DEFAULT_FRAME_BUDGET, help="The frames will be extracted where the video changes the most, using a fast low resolution pass to score the motion.")
+        frames_per_second = DEFAULT_FRAMES_PER_SECOND
+    else:
+        frame_budget = DEFAULT_FRAME_BUDGET
+        frames_per_second = st.number_input('Frames per second', DEFAULT_FRAMES_PER_SECOND, help="The number of frames to extract per second.")
     resize = st.number_input("Frames resizing ratio", min_value=0, value=RESIZE_OF_FRAMES, help="The size of the images will be reduced in proportion to this number while maintaining the height/width ratio. This reduction is useful for improving latency and reducing token consumption (0 to not resize)")
-    save_frames = st.checkbox('Save the frames to the folder "frames"', True)
+    decode_workers = st.number_input("Decoding processes", min_value=1, value=DEFAULT_DECODE_WORKERS, help="The frames are decoded in parallel by this number of processes, each one decoding a time range of the video")
+    frames_per_mosaic = st.number_input("Frames per mosaic", min_value=0, value=0, help="Consecutive frames are packed into a grid image with the timestamp of each frame, so more frames fit in the same token budget (0 or 1 to send each frame as its own image)")
+    save_frames = st.checkbox('Save the frames to the folder "frames"', True, help="The frames are saved in one pack file per video with an index, and reused when the same video is analyzed again")
     temperature = float(st.number_input('Temperature for the model', DEFAULT_TEMPERATURE))
+    stream_analysis = st.checkbox('Stream the analysis', True, help="Show the tokens of the analysis as they are generated and measure the time to first token and the tokens per second")
     system_prompt = st.text_area('System Prompt', system_prompt)
     user_prompt = st.text_area('User Prompt', USER_PROMPT)
     max_duration = st.number_input('Maximum duration to process (seconds)', 0, help="Specify the maximum duration of the video to process. If the video is longer, only this duration will be processed. Set to 0 to process the entire video.")
@@ -284,11 +327,13 @@ else:
 
 # Analyze the video when the button is pressed
 if st.button("Analyze video", use_container_width=True, type='primary'):
+    # Report of the prompt cache hits of the segments of this run
+    cache_report = CacheReport()
 
     # Show parameters:
     print(f"PARAMETERS:")
-    print(f"file_or_url: {file_or_url}, audio_transcription: {audio_transcription}, shot interval: {shot_interval}, frames per second: {frames_per_second}")
-    print(f"resize ratio: {resize}, save_frames: {save_frames}, temperature: {temperature}, max_duration: {max_duration}")
+    print(f"file_or_url: {file_or_url}, audio_transcription: {audio_transcription}, shot interval: {shot_interval}, sampling: {sampling}, frames per second: {frames_per_second}, frame budget: {frame_budget}")
+    print(f"stream_analysis: {stream_analysis}, resize ratio: {resize}, decode_workers: {decode_workers}, frames_per_mosaic: {frames_per_mosaic}, save_frames: {save_frames}, temperature: {temperature}, max_duration: {max_duration}")
 
     if file_or_url == 'URL': # Process Youtube video
         st.write(f'Analyzing video from URL {url}...')
@@ -340,7 +385,7 @@ if st.button("Analyze video", use_container_width=True, type='primary'):
                 print(f"Extracted shot: {shot_path}")
 
             # Process the video shot
-            analysis = execute_video_processing(st, shot_path, system_prompt, user_prompt, temperature, frames_per_second, analysis_subdir)
+            analysis = execute_video_processing(st, shot_path, system_prompt, user_prompt, temperature, frames_per_second, analysis_subdir, start_offset=start)
             st.markdown(f"**Description**: {analysis}", unsafe_allow_html=True)
 
             # Example detecting an event
@@ -354,25 +399,33 @@ if st.button("Analyze video", use_container_width=True, type='primary'):
             analysis_dir = f"{video_title}_video_analysis"
             os.makedirs(analysis_dir, exist_ok=True)
 
-            # Create subdirectories for shots and analysis
-            shots_dir = os.path.join(analysis_dir, "shots")
-            os.makedirs(shots_dir, exist_ok=True)
-            analysis_subdir = os.path.join(analysis_dir, "analysis")
-            os.makedirs(analysis_subdir, exist_ok=True)
+            # Write the upload in chunks to the directory of this session, in the background
+            upload = start_upload(video_file, st.session_state)
+            video_path = upload.path
 
-            video_path = os.path.join(analysis_dir, video_file.name)
+            # The shots are written next to the upload and the analyses to a subdirectory of the session,
+            # so concurrent sessions with files of the same name do not overwrite each other's shots and JSON files
+            shots_dir = os.path.dirname(video_path)
+            analysis_subdir = os.path.join(analysis_dir, "analysis", os.path.basename(st.session_state["upload_dir"]))
+            os.makedirs(analysis_subdir, exist_ok=True)
             try:
-                with open(video_path, "wb") as f:
-                    f.write(video_file.getbuffer())
-                print(f"Uploaded video file: {video_path}")
+                print(f"Uploading video file: {video_path}")
 
-                # Splitting video into shots
-                for shot_path in split_video(video_path, shots_dir, shot_interval, max_duration):
+                # Splitting video into shots, starting while the upload is still being written
+                for shot_path, shot_start in split_video(video_path, shots_dir, shot_interval, max_duration, upload=upload):
                     print(f"Processing shot: {shot_path}")
                     # Process the video shot
-                    analysis = execute_video_processing(st, shot_path, system_prompt, user_prompt, temperature, frames_per_second, analysis_subdir)
+                    analysis = execute_video_processing(st, shot_path, system_prompt, user_prompt, temperature, frames_per_second, analysis_subdir, start_offset=shot_start)
                     st.markdown(f"**Description**: {analysis}", unsafe_allow_html=True)
 
+                digest = upload.wait()
+                print(f"Uploaded video file: {video_path} (sha256: {digest}{', already uploaded' if upload.duplicate else ''})")
+
             except Exception as ex:
                 print(f'ERROR: {ex}')
                 st.write(f'ERROR: {ex}')
+
+    # Show the prompt cache hit ratio of the run
+    print(f"{cache_report}: {cache_report.summary()}")
+    if cache_report.requests > 0:
+        st.write(str(cache_report))